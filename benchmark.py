@@ -0,0 +1,523 @@
+"""Load and soak benchmarks for Gweeb's network path.
+
+Runs simulated peers on loopback addresses (127.0.0.x) in one process, with
+the zerotier interface check stubbed out and a fake clipboard standing in
+for the system one. Each peer is a real NetworkListener feeding the real
+Gweeb.ingest_received_text, so latencies cover the full path from
+send_text_to_device to the receiver's history. Clipboard writes are
+batched and counted separately.
+
+Examples:
+    python benchmark.py --peers 4 --clips 500 --size 1024
+    python benchmark.py --peers 8 --size 1048576 --clips 20 --workload append
+    python benchmark.py --soak 300 --output bench.json
+
+Results are written as JSON so CI can track them over time.
+"""
+import argparse
+import atexit
+import gc
+import json
+import os
+import platform
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import psutil
+from PySide6.QtCore import QCoreApplication, QObject, Signal, Qt
+
+import gweeb
+
+# Importing gweeb installs handlers that SIGKILL the process on exit
+atexit.unregister(gweeb.cleanup)
+if not gweeb.IS_WINDOWS:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+# Treat loopback as the zerotier network and keep notifications quiet
+gweeb.is_valid_interface = lambda ip: ip.startswith('127.')
+gweeb.HAVE_DBUS = False
+
+SEQ_WIDTH = 10  # Every clip starts with a zero-padded sequence number
+
+
+class FakeClipboard(QObject):
+    """In-memory stand-in for QClipboard that timestamps every write"""
+    dataChanged = Signal()
+
+    def __init__(self, on_set=None):
+        super().__init__()
+        self._text = ''
+        self.on_set = on_set
+
+    def text(self):
+        return self._text
+
+    def setText(self, text):
+        self._text = text
+        if self.on_set:
+            self.on_set(text)
+        self.dataChanged.emit()
+
+
+class FakeTray:
+    def showMessage(self, *args):
+        pass
+
+
+class BenchPeer(gweeb.Gweeb):
+    """A Gweeb instance without tray, discovery or pid file"""
+
+    def __init__(self, device_id, ip, port, on_receive=None, on_set=None):
+        QObject.__init__(self)
+        self.init_state(device_id)
+        # Peers are driven by the benchmark, not by their own clipboards
+        self.auto_send_enabled = False
+        self.relay_enabled = False
+        self.udp_fast_path_enabled = False
+        self.tray = FakeTray()
+        self.clipboard = FakeClipboard(on_set)
+
+        gweeb.get_local_ip = lambda: ip
+        self.listener = gweeb.NetworkListener(port)
+        self.listener.text_received.connect(self.ingest_received_text, Qt.DirectConnection)
+        self.listener.peer_health = self.peer_health.get
+        if on_receive:
+            self.listener.text_received.connect(on_receive, Qt.DirectConnection)
+        self.listener.start()
+        self.datagrams = gweeb.DatagramChannel(self.listener)
+        self.datagrams.start()
+        self.listener.datagram_info = self.datagrams.info
+
+    def update_devices_menu(self):
+        pass
+
+    def stop(self):
+        for sender in self.peer_senders.values():
+            sender.stop()
+        self.listener.stop()
+        self.listener.wait()
+        self.datagrams.stop()
+
+
+class BlackholePeer:
+    """Accepts TCP connections into the backlog but never reads them"""
+
+    def __init__(self, ip, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((ip, port))
+        self.sock.listen(64)
+
+    def stop(self):
+        self.sock.close()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_text(seq, size, workload, previous):
+    header = str(seq).zfill(SEQ_WIDTH) + ':'
+    if workload == 'append' and previous:
+        # A log tail that keeps growing; the header changes at the end so
+        # the common prefix stays intact
+        return previous[:-len(header)] + 'x' * max(1, size // 100) + header
+    body = 'x' * max(0, size - len(header))
+    return body + header if workload == 'append' else header + body
+
+
+def parse_seq(text):
+    if isinstance(text, gweeb.SpilledText):
+        text = text.preview(SEQ_WIDTH + 1)
+    try:
+        if text[SEQ_WIDTH] == ':':
+            return int(text[:SEQ_WIDTH])
+        return int(text[-SEQ_WIDTH - 1:-1])
+    except (ValueError, IndexError):
+        return None
+
+
+class Mesh:
+    """A sender plus N receiving peers on 127.0.0.x"""
+
+    def __init__(self, peers, port, dead=0, slow=0, relay=False, udp=False):
+        self.app = QCoreApplication.instance() or QCoreApplication([])
+        self.sent_at = {}
+        self.latencies = []
+        self.latency_by_seq = {}
+        self.deliveries = 0
+        self.clipboard_writes = 0
+        self.lock = threading.Lock()
+
+        self.sender = BenchPeer('BENCH0', '127.0.0.2', port)
+        self.sender.relay_enabled = relay
+        self.sender.udp_fast_path_enabled = udp
+        self.receivers = []
+        for i in range(peers):
+            ip = f'127.0.0.{i + 3}'
+            self.receivers.append(BenchPeer(f'BENCH{i + 1}', ip, port, self._on_delivered,
+                                            self._on_clipboard_set))
+        self.faulty = []
+        for i in range(dead):
+            # Nothing listens here, connections are refused immediately
+            self._pair(f'DEAD{i}', f'127.0.1.{i + 1}', port)
+        for i in range(slow):
+            ip = f'127.0.2.{i + 1}'
+            self.faulty.append(BlackholePeer(ip, port))
+            self._pair(f'SLOW{i}', ip, port)
+        for peer in self.receivers:
+            self._pair(peer.device_id, peer.listener.interface_ip, peer.listener.port)
+            peer.paired_devices[self.sender.device_id] = (self.sender.listener.interface_ip,) * 2
+        time.sleep(0.2)  # Let the listener threads bind
+        if udp:
+            # Learn the receivers' datagram keys like the heartbeat would
+            for peer in self.receivers:
+                gweeb.probe_peer(self.sender.device_endpoints[peer.device_id], ping=True)
+
+    def _pair(self, device_id, ip, port):
+        self.sender.paired_devices[device_id] = (ip, ip)
+        self.sender.device_endpoints[device_id] = gweeb.PeerEndpoint([ip], port)
+        self.sender.device_features[device_id] = set(gweeb.PROTOCOL_FEATURES)
+
+    def _on_clipboard_set(self, text):
+        self.clipboard_writes += 1
+
+    def _on_delivered(self, sender_id, text, *_):
+        now = time.perf_counter()
+        seq = parse_seq(text)
+        with self.lock:
+            self.deliveries += 1
+            if seq in self.sent_at:
+                self.latencies.append(now - self.sent_at[seq])
+                self.latency_by_seq.setdefault(seq, now - self.sent_at[seq])
+
+    def fan_out(self, seq, text):
+        targets = self.sender.fan_out_targets()
+        with self.lock:
+            self.sent_at[seq] = time.perf_counter()
+        self.sender.fan_out(targets, text, time.time_ns())
+
+    def run(self, work):
+        """Run work() on a sender thread while the main thread pumps Qt events"""
+        errors = []
+
+        def target():
+            try:
+                work()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        while thread.is_alive():
+            self.app.processEvents()
+            time.sleep(0.001)
+        if errors:
+            raise errors[0]
+
+    def wait_for(self, expected, timeout=30):
+        """Block a worker thread until expected deliveries have happened"""
+        deadline = time.time() + timeout
+        while self.deliveries < expected and time.time() < deadline:
+            time.sleep(0.0005)
+
+    def drain(self, expected, timeout=10):
+        deadline = time.time() + timeout
+        while self.deliveries < expected and time.time() < deadline:
+            self.app.processEvents()
+            time.sleep(0.001)
+        self.settle()
+
+    def settle(self):
+        """Pump events until batched clipboard updates have been applied"""
+        deadline = time.time() + 2 * gweeb.RECEIVE_BATCH_INTERVAL / 1000.0
+        while time.time() < deadline:
+            self.app.processEvents()
+            time.sleep(0.001)
+
+    def stop(self):
+        for peer in [self.sender] + self.receivers:
+            peer.stop()
+        for peer in self.faulty:
+            peer.stop()
+
+
+def run_throughput(args, quiet):
+    with quiet:
+        mesh = Mesh(args.peers, args.port, relay=args.relay, udp=args.udp)
+    sizes = []
+
+    def work():
+        previous = None
+        for seq in range(args.clips):
+            text = make_text(seq, args.size, args.workload, previous)
+            previous = text
+            sizes.append(len(text.encode('utf-8')))
+            mesh.fan_out(seq, text)
+
+    try:
+        with quiet:
+            start = time.perf_counter()
+            mesh.run(work)
+            mesh.drain(args.clips * args.peers)
+            elapsed = time.perf_counter() - start
+    finally:
+        with quiet:
+            mesh.stop()
+
+    delivered_bytes = sum(sizes) * args.peers * mesh.deliveries / max(1, args.clips * args.peers)
+    return {
+        'clips': args.clips,
+        'peers': args.peers,
+        'expected_deliveries': args.clips * args.peers,
+        'deliveries': mesh.deliveries,
+        'elapsed_s': elapsed,
+        'clips_per_s': mesh.deliveries / elapsed if elapsed else None,
+        'mb_per_s': delivered_bytes / elapsed / 1e6 if elapsed else None,
+        'latency_p50_ms': _ms(percentile(mesh.latencies, 50)),
+        'latency_p99_ms': _ms(percentile(mesh.latencies, 99)),
+        'latency_max_ms': _ms(max(mesh.latencies) if mesh.latencies else None),
+        'clipboard_writes': mesh.clipboard_writes,
+    }
+
+
+def run_faults(args, quiet):
+    with quiet:
+        mesh = Mesh(args.peers, args.port + 1, dead=args.dead_peers, slow=args.slow_peers)
+    fan_out_times = []
+
+    def work():
+        for seq in range(args.fault_clips):
+            text = make_text(seq, args.size, 'replace', None)
+            start = time.perf_counter()
+            mesh.fan_out(seq, text)
+            fan_out_times.append(time.perf_counter() - start)
+
+    try:
+        with quiet:
+            mesh.run(work)
+            mesh.drain(args.fault_clips * args.peers)
+    finally:
+        with quiet:
+            mesh.stop()
+
+    return {
+        'clips': args.fault_clips,
+        'healthy_peers': args.peers,
+        'dead_peers': args.dead_peers,
+        'slow_peers': args.slow_peers,
+        'deliveries': mesh.deliveries,
+        'faulty_peer_states': {device_id: health.state
+                               for device_id, health in mesh.sender.peer_health.items()
+                               if device_id.startswith(('DEAD', 'SLOW'))},
+        # Sends are queued per peer, so this is only the time to hand the clip off
+        'fan_out_p50_ms': _ms(percentile(fan_out_times, 50)),
+        'fan_out_max_ms': _ms(max(fan_out_times) if fan_out_times else None),
+        'latency_p50_ms': _ms(percentile(mesh.latencies, 50)),
+        'latency_p99_ms': _ms(percentile(mesh.latencies, 99)),
+    }
+
+
+def run_soak(args, quiet):
+    with quiet:
+        mesh = Mesh(args.peers, args.port + 2)
+    process = psutil.Process()
+    samples = []
+    tracemalloc.start()
+    stop = threading.Event()
+    sent = [0]
+
+    def work():
+        previous = None
+        seq = 0
+        while not stop.is_set():
+            text = make_text(seq, args.size, args.workload, previous)
+            previous = text
+            mesh.fan_out(seq, text)
+            seq += 1
+            sent[0] = seq
+            # Keep a bounded number of clips in flight instead of growing the send queues
+            mesh.wait_for((seq - args.window) * args.peers)
+
+    def sample(elapsed):
+        gc.collect()
+        traced, _ = tracemalloc.get_traced_memory()
+        samples.append({
+            't_s': round(elapsed, 3),
+            'sent': sent[0],
+            'deliveries': mesh.deliveries,
+            'rss_mb': process.memory_info().rss / 1e6,
+            'traced_mb': traced / 1e6,
+            'history_entries': sum(len(p.received_texts) for p in mesh.receivers),
+        })
+
+    try:
+        with quiet:
+            thread = threading.Thread(target=work, daemon=True)
+            start = time.perf_counter()
+            thread.start()
+            next_sample = 0
+            while time.perf_counter() - start < args.soak:
+                mesh.app.processEvents()
+                elapsed = time.perf_counter() - start
+                if elapsed >= next_sample:
+                    sample(elapsed)
+                    next_sample += args.sample_interval
+                time.sleep(0.001)
+            stop.set()
+            while thread.is_alive():
+                mesh.app.processEvents()
+                time.sleep(0.001)
+            mesh.drain(sent[0] * args.peers)
+            sample(time.perf_counter() - start)
+    finally:
+        with quiet:
+            mesh.stop()
+        tracemalloc.stop()
+
+    first, last = samples[0], samples[-1]
+    return {
+        'duration_s': args.soak,
+        'sent': sent[0],
+        'deliveries': mesh.deliveries,
+        'rss_growth_mb': last['rss_mb'] - first['rss_mb'],
+        'traced_growth_mb': last['traced_mb'] - first['traced_mb'],
+        'latency_p50_ms': _ms(percentile(mesh.latencies, 50)),
+        'latency_p99_ms': _ms(percentile(mesh.latencies, 99)),
+        'samples': samples,
+    }
+
+
+def run_priority(args, quiet):
+    """Time a small clip copied while a bulk clip to the same peer is in flight"""
+    with quiet:
+        mesh = Mesh(1, args.port + 3)
+    receiver = mesh.receivers[0]
+    bulk = make_text(0, args.bulk_size, 'replace', None)
+    small = make_text(1, 100, 'replace', None)
+    arrivals = {}
+
+    def work():
+        mesh.fan_out(0, bulk)
+        time.sleep(args.bulk_head_start)
+        mesh.fan_out(1, small)
+
+    try:
+        with quiet:
+            start = time.perf_counter()
+            mesh.run(work)
+            deadline = time.time() + 60
+            while len(receiver.received_texts) < 2 and time.time() < deadline:
+                mesh.app.processEvents()
+                for entry in receiver.received_texts:
+                    seq = parse_seq(entry['text'])
+                    arrivals.setdefault(seq, time.perf_counter())
+                time.sleep(0.0005)
+            mesh.settle()
+            for entry in receiver.received_texts:
+                arrivals.setdefault(parse_seq(entry['text']), time.perf_counter())
+    finally:
+        with quiet:
+            mesh.stop()
+
+    def latency(seq):
+        if seq not in arrivals:
+            return None
+        return _ms(arrivals[seq] - mesh.sent_at[seq])
+
+    return {
+        'bulk_size': args.bulk_size,
+        'bulk_latency_ms': latency(0),
+        'small_latency_ms': latency(1),
+        'small_before_bulk': arrivals.get(1, float('inf')) < arrivals.get(0, float('inf')),
+        'clipboard_has_newest': parse_seq(receiver.clipboard.text()) == 1,
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+class _Quiet:
+    """Silence Gweeb's prints unless --verbose is given"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if self.enabled:
+            self._stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            sys.stdout.close()
+            sys.stdout = self._stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--peers', type=int, default=4, help='Number of receiving peers')
+    parser.add_argument('--clips', type=int, default=200, help='Clips sent in the throughput run')
+    parser.add_argument('--size', type=int, default=1024, help='Clip size in bytes')
+    parser.add_argument('--workload', choices=['replace', 'append'], default='replace',
+                        help='replace sends unrelated clips, append grows one clip like a log tail')
+    parser.add_argument('--relay', action='store_true', help='Fan out through the relay tree')
+    parser.add_argument('--udp', action='store_true',
+                        help='Send clips that fit in a datagram over the UDP fast path')
+    parser.add_argument('--dead-peers', type=int, default=1, help='Peers that refuse connections')
+    parser.add_argument('--slow-peers', type=int, default=1, help='Peers that accept but never read')
+    parser.add_argument('--fault-clips', type=int, default=3, help='Clips sent in the fault run')
+    parser.add_argument('--bulk-size', type=int, default=32 * 1024 * 1024,
+                        help='Size of the bulk clip in the priority run (0 to skip)')
+    parser.add_argument('--bulk-head-start', type=float, default=0.05,
+                        help='Seconds the bulk clip is sent before the small one')
+    parser.add_argument('--soak', type=float, default=0, help='Soak duration in seconds (0 to skip)')
+    parser.add_argument('--window', type=int, default=8, help='Clips in flight during the soak')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Soak sampling interval')
+    parser.add_argument('--upload-limit', type=int, help='Global upload limit in bytes/s')
+    parser.add_argument('--port', type=int, default=47555, help='Base listener port')
+    parser.add_argument('--skip-faults', action='store_true', help='Skip the dead/slow peer run')
+    parser.add_argument('--output', help='Write JSON results here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help="Show Gweeb's own output")
+    args = parser.parse_args()
+
+    quiet = _Quiet(not args.verbose)
+    if args.upload_limit:
+        gweeb.global_upload_bucket.set_limit(args.upload_limit)
+    results = {
+        'benchmark': 'gweeb-network',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'throughput': run_throughput(args, quiet),
+    }
+    if not args.skip_faults and (args.dead_peers or args.slow_peers):
+        results['faults'] = run_faults(args, quiet)
+    if args.bulk_size > 0:
+        results['priority'] = run_priority(args, quiet)
+    if args.soak > 0:
+        results['soak'] = run_soak(args, quiet)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f"Results written to {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
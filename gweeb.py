@@ -1,4 +1,5 @@
 import sys
+import argparse
 import random
 import string
 import socket
@@ -8,13 +9,35 @@
 import atexit
 import psutil
 import platform
+import hashlib
+import hmac
+import base64
+import mmap
+import struct
+import tempfile
+import shutil
+import weakref
+import errno
+import ipaddress
+import selectors
+import select
+import cProfile
+import tracemalloc
+import traceback
+import zipfile
+import codecs
+import contextlib
+import functools
+import getpass
 from PySide6.QtWidgets import (QApplication, QSystemTrayIcon, QMenu, QWidget,
                             QVBoxLayout, QTextEdit, QPushButton, QInputDialog,
                             QLineEdit, QMessageBox, QListWidget, QListWidgetItem,
                             QHBoxLayout)
 from PySide6.QtGui import QIcon, QPixmap, QImage, QCursor, QClipboard
-from PySide6.QtCore import Qt, QObject, Signal, QThread, QTimer
+from PySide6.QtCore import Qt, QObject, Signal, QThread, QTimer, QMimeData, QSocketNotifier
+from PySide6.QtNetwork import QLocalServer, QLocalSocket
 import threading
+import collections
 from zeroconf import ServiceInfo, Zeroconf, ServiceBrowser, ServiceStateChange
 import socket
 import time
@@ -24,6 +47,59 @@
 IS_WINDOWS = platform.system() == "Windows"
 IS_LINUX = platform.system() == "Linux"
 
+MAX_MESSAGE_SIZE = 1024 * 1024  # Limit for unframed JSON messages and headers
+MAX_CLIP_SIZE = 1024 * 1024 * 1024  # Limit for the text body of a framed message
+SPILL_THRESHOLD = 8 * 1024 * 1024  # Received clips larger than this are kept on disk
+SPILL_PREFIX = 'gweeb-spill-'  # Each instance spills into its own private temp directory named with this prefix and its pid
+FRAME_MAGIC = b'GWB1'
+INTERACTIVE_MAX_SIZE = 64 * 1024  # Clips up to this size skip ahead of bulk transfers
+CHUNK_SIZE = 64 * 1024  # Bulk transfers are interleaved with other clips at this granularity
+STREAM_SNDBUF = 256 * 1024  # Limits bulk data queued in the kernel ahead of interactive clips
+PEER_IDLE_TIMEOUT = 60  # Receivers drop persistent connections idle for this long
+SENDER_IDLE_CLOSE = 30  # Senders close persistent connections idle for this long
+SHAPE_SLICE = 16 * 1024  # Rate limited writes are split into slices of this size
+PING_INTERVAL = 0.25  # Seconds between latency probes during a bulk transfer
+RTT_BACKOFF_FACTOR = 2.0  # Back off once RTT exceeds this multiple of the baseline...
+RTT_QUEUE_TARGET = 0.025  # ...and at least this many seconds of queueing delay
+MIN_ADAPTIVE_RATE = 32 * 1024  # Adaptive backoff never goes below this many bytes/s
+HEARTBEAT_INTERVAL = 10  # Seconds between health probes of each paired device
+DEFAULT_TIMEOUT = 5  # Connect and read timeout for peers without RTT measurements
+MIN_CONNECT_TIMEOUT = 1.0  # RTT-derived timeouts never go below these...
+MIN_READ_TIMEOUT = 2.0  # ...so a single lost packet doesn't fail a send
+CONNECT_STAGGER = 0.25  # Seconds between connection attempts to a peer's addresses (RFC 8305)
+DOWN_AFTER_FAILURES = 2  # Consecutive failed probes or sends before a peer counts as down
+FLAP_WINDOW = 120  # A peer going up or down FLAP_TRANSITIONS times in this many seconds...
+FLAP_TRANSITIONS = 4  # ...is flapping and skipped like a down peer
+UPLOAD_LIMIT_CHOICES = [None, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 10 * 1024 * 1024]
+DELTA_MIN_SIZE = 4096  # Clips smaller than this are always sent in full
+DELTA_COMPARE_CHUNK = 64 * 1024  # Characters compared at a time when looking for the changed part
+RECEIVE_BATCH_INTERVAL = 100  # Milliseconds between clipboard updates while clips keep arriving
+RELAY_FANOUT = 3  # Peers each node uploads to when relaying through a tree
+RELAY_MIN_SIZE = INTERACTIVE_MAX_SIZE  # Smaller clips go to every peer directly, relaying them only adds hops
+UDP_MAGIC = b'GWU1'
+UDP_MAX_DATAGRAM = 1400  # Messages whose datagram would be larger go over TCP
+UDP_RETRIES = 2  # Retransmissions before a datagram send falls back to TCP
+UDP_INITIAL_RTO = 0.5  # Datagram retransmission timeout before the peer's RTT is known...
+UDP_MIN_RTO = 0.05  # ...and the lowest one derived from its RTT
+SHUTDOWN_TIMEOUT = 3  # Seconds a graceful shutdown waits for queued clips to go out
+CONTROL_TIMEOUT = 1  # Seconds to wait for a running instance to take a stop request
+STATE_MAX_CLIP = 1024 * 1024  # Larger clips aren't saved across restarts
+HISTORY_SAVE_LIMIT = 500  # Received clips kept across restarts
+OUTBOX_MAX_AGE = 600  # Seconds after which unsent clips saved at shutdown are dropped
+HISTORY_SYNC_PAGE_SIZE = MAX_MESSAGE_SIZE // 2  # Encoded entries per history sync reply, larger entries aren't synced
+HISTORY_BLOOM_BITS = 10  # Bloom filter bits per entry in a history summary (about 1% false positives)...
+HISTORY_BLOOM_HASHES = 7  # ...with this many hash functions
+HISTORY_SYNC_MAX_SKEW = 60  # Seconds a signed history sync request stays valid
+HISTORY_SYNC_RETRIES = 3  # Failed history syncs are retried this many times...
+HISTORY_SYNC_RETRY_DELAY = 2  # ...after this many seconds, doubling each time
+LISTEN_BACKLOG = 64  # A whole fleet may connect at once to sync with a machine that just joined
+PROFILE_SAMPLE_INTERVAL = 0.01  # Seconds between stack samples of every thread while profiling
+TRACEMALLOC_FRAMES = 10  # Stack depth recorded for each allocation while tracing memory
+MEMORY_REPORT_TOP = 25  # Allocation sites listed in a memory snapshot report
+LOG_TAIL_LINES = 2000  # Lines of our own output kept for diagnostics bundles
+EVENT_LOOP_CHECK_INTERVAL = 500  # Milliseconds between checks of how late the GUI event loop runs
+PROTOCOL_FEATURES = ['delta', 'relay', 'frame', 'stream', 'ping', 'endpoints', 'history']  # Advertised in the discovery TXT record
+
 # For Linux desktop notifications
 if IS_LINUX:
     try:
@@ -32,7 +108,48 @@
         HAVE_DBUS = True
     except ImportError:
         HAVE_DBUS = False
-        print("Warning: dbus-python not installed, falling back to Qt notifications")
+        print("Warning: dbus-python not installed, falling back to Qt notifications", file=sys.stderr)
+
+class TimingStats:
+    """Counts, totals and maxima of how long named operations take.
+    Cheap enough to stay on all the time, and shown in diagnostics bundles."""
+
+    def __init__(self):
+        self.stats = {}  # name -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            stat = self.stats.setdefault(name, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {'count': count, 'total_ms': round(total * 1000, 3),
+                           'mean_ms': round(total / count * 1000, 3), 'max_ms': round(peak * 1000, 3)}
+                    for name, (count, total, peak) in sorted(self.stats.items())}
+
+TIMINGS = TimingStats()
+
+def timed(name):
+    """Decorator recording every call of a function in TIMINGS under name"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with TIMINGS.timed(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
 
 def get_local_ip():
     """Get the local IP address that can be used for LAN communication"""
@@ -103,9 +220,1211 @@ def get_local_ip():
         print(f"Using hostname method, found IP: {ip}")
         return ip
 
+def get_local_addresses(primary):
+    """Return primary followed by this machine's other zerotier addresses, IPv4 and IPv6"""
+    found = []
+    if IS_WINDOWS:
+        try:
+            import subprocess
+            output = subprocess.check_output("ipconfig", shell=True).decode()
+            for line in output.split('\n'):
+                if "IPv4 Address" in line or "IPv6 Address" in line:
+                    found.append(line.split(": ")[-1].strip().replace('(Preferred)', ''))
+        except Exception as e:
+            print(f"Windows ipconfig method failed: {e}")
+    else:
+        try:
+            import netifaces
+            for interface in netifaces.interfaces():
+                addrs = netifaces.ifaddresses(interface)
+                for family in (netifaces.AF_INET, netifaces.AF_INET6):
+                    found.extend(addr['addr'] for addr in addrs.get(family, []))
+        except ImportError:
+            pass
+    addresses = [primary]
+    for address in found:
+        address = address.split('%')[0]
+        if is_valid_interface(address) and address not in addresses:
+            addresses.append(address)
+    return addresses
+
 def is_valid_interface(ip):
-    """Check if the IP is on our zerotier network"""
-    return ip.startswith('172.26.')
+    """Check if the IP is on our zerotier network, IPv4 or one of zerotier's IPv6 schemes"""
+    if ip.startswith('172.26.'):
+        return True
+    try:
+        packed = ipaddress.IPv6Address(ip.split('%')[0]).packed
+    except ValueError:
+        return False
+    # RFC4193 addresses are fd, the 64-bit network id, 9993 and the node id;
+    # 6PLANE addresses are the only ones in fc00::/8
+    return (packed[0] == 0xfd and packed[9:11] == b'\x99\x93') or packed[0] == 0xfc
+
+def content_hash(text):
+    """Short hash used by peers to agree on which clip they are talking about"""
+    if isinstance(text, SpilledText):
+        return text.hash
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+def _remove_spill_file(mapping, file, path):
+    try:
+        if mapping is not None:
+            mapping.close()
+        file.close()
+        os.remove(path)
+    except OSError:
+        pass
+
+class SpilledText:
+    """Received UTF-8 text kept in a temp file and read through mmap.
+
+    Stands in for a str in the history and across the text_received signal so
+    that very large clips only take memory when they are materialized.
+    """
+
+    def __init__(self, path, size, text_hash):
+        self.path = path
+        self.size = size
+        self.hash = text_hash
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._finalizer = weakref.finalize(self, _remove_spill_file, self._map, self._file, path)
+
+    @classmethod
+    def receive(cls, sock, length):
+        """Stream length bytes from sock straight into a spill file"""
+        writer = SpillWriter()
+        try:
+            remaining = length
+            while remaining:
+                chunk = sock.recv(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise ConnectionError("Connection closed mid-message")
+                writer.write(chunk)
+                remaining -= len(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.finish()
+
+    @classmethod
+    def from_text(cls, text):
+        writer = SpillWriter()
+        writer.write(text.encode('utf-8'))
+        return writer.finish()
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        return memoryview(self._map) if self._map is not None else memoryview(b'')
+
+    def materialize(self):
+        """Decode the whole clip into a str"""
+        return str(self._map, 'utf-8') if self._map is not None else ''
+
+    def preview(self, limit=500):
+        if self._map is None:
+            return ''
+        return str(self._map[:limit], 'utf-8', errors='ignore')
+
+class SpillWriter:
+    """Writes a clip to a new spill file piece by piece.
+
+    The data is checked to be UTF-8 as it is written, like in-memory bodies
+    are when they are decoded, and UnicodeDecodeError is raised otherwise.
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='gweeb-clip-', suffix='.txt', dir=spill_dir())
+        self._file = os.fdopen(fd, 'wb')
+        self._digest = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.size = 0
+
+    def write(self, data):
+        try:
+            self._decoder.decode(data)
+        except UnicodeDecodeError:
+            self.abort()
+            raise
+        self._digest.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        self._file.close()
+        try:
+            # Fails if the data ends partway through a character
+            self._decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            self.abort()
+            raise
+        return SpilledText(self.path, self.size, self._digest.hexdigest()[:32])
+
+    def abort(self):
+        try:
+            self._file.close()
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def materialize(text):
+    """Return text as a str, loading it from disk if it was spilled"""
+    return text.materialize() if isinstance(text, SpilledText) else text
+
+class LazyClipMimeData(QMimeData):
+    """Clipboard contents for a received clip that are produced on demand.
+
+    Only the text formats are advertised. The clip is read from memory or its
+    spill file when another application actually asks for it, instead of when
+    it is put on the clipboard.
+    """
+    FORMATS = ['text/plain', 'text/plain;charset=utf-8']
+
+    def __init__(self, text):
+        super().__init__()
+        self._source = text
+        self._text = None
+
+    def formats(self):
+        return list(self.FORMATS)
+
+    def hasFormat(self, mime_type):
+        return mime_type in self.FORMATS
+
+    def retrieveData(self, mime_type, preferred_type):
+        if mime_type not in self.FORMATS:
+            return None
+        if self._text is None:
+            print(f"Clipboard data requested as {mime_type}, rendering received text")
+            self._text = materialize(self._source)
+        return self._text
+
+_spill_dir = None
+_spill_dir_lock = threading.Lock()
+
+def spill_dir():
+    """Return this instance's spill directory, creating it on first use.
+
+    mkdtemp makes it readable by us only, and other users or instances of
+    Gweeb never share it.
+    """
+    global _spill_dir
+    with _spill_dir_lock:
+        if _spill_dir is None:
+            _spill_dir = tempfile.mkdtemp(prefix=f'{SPILL_PREFIX}{os.getpid()}-')
+        return _spill_dir
+
+def _clear_stale_spill_dirs():
+    # Spill files are removed when their clip is dropped, but not if we were
+    # killed. Remove our own directories left by instances that are gone.
+    root = tempfile.gettempdir()
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(SPILL_PREFIX):
+            continue
+        path = os.path.join(root, name)
+        try:
+            pid = int(name[len(SPILL_PREFIX):].split('-', 1)[0])
+            if hasattr(os, 'getuid') and os.stat(path).st_uid != os.getuid():
+                continue
+        except (ValueError, OSError):
+            continue
+        if pid != os.getpid() and not psutil.pid_exists(pid):
+            shutil.rmtree(path, ignore_errors=True)
+
+def _common_prefix_length(a, b):
+    # Compare DELTA_COMPARE_CHUNK characters at a time so each character is
+    # copied about once, then find the first difference within the chunk
+    limit = min(len(a), len(b))
+    start = 0
+    while start < limit:
+        end = min(start + DELTA_COMPARE_CHUNK, limit)
+        if a[start:end] != b[start:end]:
+            break
+        start = end
+    else:
+        return limit
+    while a[start] == b[start]:
+        start += 1
+    return start
+
+def _common_suffix_length(a, b, limit):
+    length = 0
+    while length < limit:
+        size = min(DELTA_COMPARE_CHUNK, limit - length)
+        if a[len(a) - length - size:len(a) - length] != b[len(b) - length - size:len(b) - length]:
+            break
+        length += size
+    else:
+        return limit
+    while a[len(a) - length - 1] == b[len(b) - length - 1]:
+        length += 1
+    return length
+
+def make_delta(base, text):
+    """Build a prefix/suffix diff turning base into text.
+
+    Returns None when the diff would not be meaningfully smaller than the text.
+    """
+    if len(text) < DELTA_MIN_SIZE:
+        return None
+    prefix = _common_prefix_length(base, text)
+    suffix = _common_suffix_length(base, text, min(len(base), len(text)) - prefix)
+    insert = text[prefix:len(text) - suffix]
+    if len(insert) > len(text) // 2:
+        return None
+    return {'prefix': prefix, 'suffix': suffix, 'insert': insert}
+
+def apply_delta(base, delta):
+    """Rebuild the full text from base and a diff produced by make_delta"""
+    base = materialize(base)
+    text = base[:delta['prefix']] + materialize(delta['insert']) + base[len(base) - delta['suffix']:]
+    if len(text) > SPILL_THRESHOLD:
+        return SpilledText.from_text(text)
+    return text
+
+def _recv_all(sock, limit=MAX_MESSAGE_SIZE):
+    """Read from sock until the peer shuts down its side of the connection"""
+    chunks = []
+    received = 0
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        received += len(chunk)
+        if received > limit:
+            raise ValueError(f"Message exceeds {limit} bytes")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def _recv_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(min(length - len(data), 65536))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message")
+        data += chunk
+    return bytes(data)
+
+def _split_message(message):
+    """Separate a message into its JSON header and raw UTF-8 body"""
+    header = dict(message)
+    if 'delta' in header:
+        header['delta'] = dict(header['delta'])
+        body = header['delta'].pop('insert')
+    else:
+        body = header.pop('text')
+    body = body.view() if isinstance(body, SpilledText) else body.encode('utf-8')
+    return header, body
+
+def message_size(message):
+    """Size of the text a message carries, used to pick its priority lane"""
+    body = message['delta']['insert'] if 'delta' in message else message['text']
+    return len(body)
+
+class TokenBucket:
+    """Thread-safe token bucket limiting bytes per second.
+
+    limit is the configured rate and rate the one currently enforced, which
+    adaptive backoff may lower. A rate of None means unlimited.
+    """
+
+    def __init__(self, limit=None):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.rate = limit
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = limit
+            self.rate = limit
+            self.tokens = 0.0
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate is not None and self.limit is not None:
+                rate = min(rate, self.limit)
+            self.rate = rate
+
+    def consume(self, amount):
+        """Take amount tokens, sleeping until the bucket has paid them back"""
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            burst = max(self.rate * 0.1, SHAPE_SLICE)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+# Shared by every upload: sends, relays and the send dialog
+global_upload_bucket = TokenBucket()
+
+def shaped_sendall(sock, data, buckets=()):
+    """sendall that waits on the global and given token buckets between slices"""
+    buckets = [bucket for bucket in (global_upload_bucket,) + tuple(buckets)
+               if bucket and bucket.rate is not None]
+    if not buckets:
+        sock.sendall(data)
+        return
+    view = memoryview(data)
+    for offset in range(0, len(view), SHAPE_SLICE):
+        piece = view[offset:offset + SHAPE_SLICE]
+        for bucket in buckets:
+            bucket.consume(len(piece))
+        sock.sendall(piece)
+
+def format_rate(rate):
+    if rate is None:
+        return "Unlimited"
+    if rate >= 1024 * 1024:
+        return f"{rate / (1024 * 1024):g} MB/s"
+    return f"{rate / 1024:g} KB/s"
+
+def _write_raw_frame(sock, header, body, buckets=()):
+    header = dict(header, length=len(body))
+    encoded_header = json.dumps(header).encode('utf-8')
+    shaped_sendall(sock, FRAME_MAGIC + struct.pack('!I', len(encoded_header)) + encoded_header, buckets)
+    shaped_sendall(sock, body, buckets)
+
+def write_frame(sock, message, buckets=()):
+    """Send message as a binary frame: magic, header length, JSON header, raw text.
+
+    The text (or delta insert) travels as raw UTF-8 after the header instead of
+    as an escaped JSON string, so the receiver can stream it to disk.
+    """
+    header, body = _split_message(message)
+    print(f"Sending framed message with {len(body)} byte body")
+    _write_raw_frame(sock, header, body, buckets)
+
+def iter_chunk_frames(msg_id, message, chunk_size=CHUNK_SIZE):
+    """Yield (header, body) frames carrying message in chunks of chunk_size.
+
+    The first frame has the message header; later ones only say which message
+    and offset they continue, so frames of different messages can be interleaved.
+    """
+    header, body = _split_message(message)
+    total = len(body)
+    offset = 0
+    while True:
+        chunk = body[offset:offset + chunk_size]
+        if offset == 0:
+            frame_header = dict(header, msg_id=msg_id, total=total)
+        else:
+            frame_header = {'msg_id': msg_id}
+        frame_header['offset'] = offset
+        frame_header['more'] = offset + len(chunk) < total
+        yield frame_header, chunk
+        offset += len(chunk)
+        if offset >= total:
+            break
+
+def _attach_body(header, body):
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode('utf-8')
+    if 'delta' in header:
+        header['delta']['insert'] = body
+    else:
+        header['text'] = body
+    return header
+
+def read_frame(sock):
+    """Read one frame from sock.
+
+    Returns (header, body), (message, None) for unframed JSON from an older
+    peer, or (None, None) at end of stream. Bodies larger than SPILL_THRESHOLD
+    come back as SpilledText.
+    """
+    start = sock.recv(len(FRAME_MAGIC))
+    if not start:
+        return None, None
+    if len(start) < len(FRAME_MAGIC) and FRAME_MAGIC.startswith(start):
+        start += _recv_exact(sock, len(FRAME_MAGIC) - len(start))
+    if start != FRAME_MAGIC:
+        # Unframed JSON from an older peer
+        return json.loads((start + _recv_all(sock)).decode('utf-8')), None
+
+    header_length = struct.unpack('!I', _recv_exact(sock, 4))[0]
+    if header_length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Header exceeds {MAX_MESSAGE_SIZE} bytes")
+    header = json.loads(_recv_exact(sock, header_length).decode('utf-8'))
+    length = header.pop('length')
+    if length > MAX_CLIP_SIZE:
+        raise ValueError(f"Message exceeds {MAX_CLIP_SIZE} bytes")
+    if length > SPILL_THRESHOLD:
+        print(f"Spilling {length} byte message to disk")
+        return header, SpilledText.receive(sock, length)
+    return header, _recv_exact(sock, length)
+
+class MessageAssembler:
+    """Rebuilds messages from the frames arriving on one connection"""
+
+    def __init__(self):
+        self.partial = {}  # msg_id -> (header, body buffer or SpillWriter)
+
+    def add(self, header, body):
+        """Add a frame. Returns the message once it is complete, otherwise None."""
+        msg_id = header.get('msg_id')
+        if msg_id is None or (header.get('offset', 0) == 0 and not header.get('more')):
+            # A whole message in a single frame
+            return _attach_body(header, body)
+
+        if header.get('offset', 0) == 0:
+            if header['total'] > MAX_CLIP_SIZE:
+                raise ValueError(f"Message exceeds {MAX_CLIP_SIZE} bytes")
+            buffer = SpillWriter() if header['total'] > SPILL_THRESHOLD else bytearray()
+            self.partial[msg_id] = (header, buffer)
+        elif msg_id not in self.partial:
+            raise ValueError(f"Continuation for unknown message {msg_id}")
+
+        first_header, buffer = self.partial[msg_id]
+        if isinstance(buffer, SpillWriter):
+            buffer.write(body)
+        else:
+            buffer += body
+        if header.get('more'):
+            return None
+
+        del self.partial[msg_id]
+        if isinstance(buffer, SpillWriter):
+            return _attach_body(first_header, buffer.finish())
+        return _attach_body(first_header, buffer)
+
+    def abort(self):
+        for _, buffer in self.partial.values():
+            if isinstance(buffer, SpillWriter):
+                buffer.abort()
+        self.partial.clear()
+
+_CONNECT_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', None)}
+
+def _start_connect(address, port, local_interface=None):
+    """Create a non-blocking socket and start connecting it to address"""
+    family, type_, proto, _, sockaddr = socket.getaddrinfo(address, port, 0, socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        if local_interface and family == socket.AF_INET and ':' not in local_interface:
+            sock.bind((local_interface, 0))
+        err = sock.connect_ex(sockaddr)
+        if err not in _CONNECT_IN_PROGRESS:
+            raise OSError(err, f"{os.strerror(err)} ({address})")
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+def connect_any(addresses, port, local_interface=None, timeout=DEFAULT_TIMEOUT, stagger=CONNECT_STAGGER):
+    """Connect to whichever of addresses answers first ("happy eyeballs", RFC 8305).
+
+    Attempts start stagger seconds apart, or right away once the previous one
+    fails, and the first connection to complete wins. Returns (socket, address)
+    with the socket in blocking mode. Raises OSError if none of the addresses
+    could be reached within timeout.
+    """
+    pending = list(addresses)
+    attempts = {}  # socket -> address
+    selector = selectors.DefaultSelector()
+    deadline = time.monotonic() + timeout
+    next_start = 0
+    error = None
+    try:
+        while pending or attempts:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if pending and (not attempts or now >= next_start):
+                address = pending.pop(0)
+                try:
+                    sock = _start_connect(address, port, local_interface)
+                except OSError as e:
+                    error = e
+                    continue
+                attempts[sock] = address
+                selector.register(sock, selectors.EVENT_WRITE)
+                next_start = now + stagger
+                continue
+            wait = deadline - now
+            if pending:
+                wait = min(wait, next_start - now)
+            for key, _ in selector.select(max(wait, 0)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                address = attempts.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if not err:
+                    sock.setblocking(True)
+                    return sock, address
+                sock.close()
+                error = OSError(err, f"{os.strerror(err)} ({address})")
+                next_start = time.monotonic()
+        if error and not attempts:
+            raise error
+        raise socket.timeout(f"timed out connecting to {', '.join(addresses)}")
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+
+class PeerEndpoint:
+    """The addresses and port a peer advertised.
+
+    Connections race all usable addresses and the one that connected first
+    is tried first from then on, so a multi-homed peer costs a single
+    connection attempt once its fastest address is known.
+    """
+
+    def __init__(self, addresses, port):
+        self.addresses = list(addresses)
+        self.port = port
+        self.preferred = None  # Address of the last successful connection
+        self.datagram = None  # (port, key) of the peer's DatagramChannel, learned from its pongs
+
+    @property
+    def address(self):
+        """The address connections are most likely to use"""
+        return self.preferred or (self.usable() or self.addresses or [None])[0]
+
+    def usable(self):
+        """Addresses on our network, in the order they should be tried"""
+        addresses = [a for a in self.addresses if is_valid_interface(a)]
+        if self.preferred in addresses:
+            addresses.remove(self.preferred)
+            addresses.insert(0, self.preferred)
+        return addresses
+
+    def learn(self, pong):
+        """Remember the datagram port and key a peer's pong advertised"""
+        if pong.get('udp_port') and pong.get('udp_key'):
+            self.datagram = (pong['udp_port'], bytes.fromhex(pong['udp_key']))
+
+    def connect(self, local_interface=None, timeout=DEFAULT_TIMEOUT):
+        addresses = self.usable()
+        if not addresses:
+            raise OSError(f"No usable address among {', '.join(self.addresses) or 'none'}")
+        sock, address = connect_any(addresses, self.port, local_interface, timeout)
+        if address != self.preferred:
+            if len(addresses) > 1:
+                print(f"Connected through {address}, the fastest of {len(addresses)} addresses")
+            self.preferred = address
+        return sock
+
+def relay_entry(device_id, endpoint, features):
+    """Build the relay list entry a peer forwards a clip to device_id with"""
+    return [device_id, endpoint.address, sorted(features), endpoint.port, endpoint.addresses]
+
+def relay_entry_endpoint(entry, default_port):
+    """Return the PeerEndpoint of a relay list entry.
+
+    Entries from peers without the 'endpoints' feature only have
+    [device_id, ip, features]; their port is assumed to be ours.
+    """
+    port = entry[3] if len(entry) > 3 else default_port
+    addresses = entry[4] if len(entry) > 4 else [entry[1]]
+    return PeerEndpoint(addresses, port)
+
+def relay_list_for(features, entries):
+    """Strip relay entries down to [device_id, ip, features] for peers that can't parse more"""
+    if 'endpoints' in features:
+        return entries
+    return [entry[:3] for entry in entries]
+
+@timed('send_message')
+def send_message(endpoint, message, local_interface=None, timeout=DEFAULT_TIMEOUT, framed=False,
+                 buckets=(), read_timeout=None):
+    """Send a message to the peer at endpoint and return its decoded reply.
+
+    timeout applies to connecting and read_timeout, which defaults to the
+    same value, to every write and read after that.
+    framed should only be set for peers advertising the 'frame' feature.
+    Uploads are limited by the global bucket and any extra buckets given.
+    Returns None if the peer closed the connection without replying, which
+    is what older versions of Gweeb do.
+    """
+    print(f"Connecting to {endpoint.address}:{endpoint.port}...")
+    client = endpoint.connect(local_interface, timeout)
+    try:
+        print("Connected successfully")
+        client.settimeout(read_timeout or timeout)
+        if framed:
+            write_frame(client, message, buckets)
+        else:
+            if isinstance(message.get('text'), SpilledText):
+                message = dict(message, text=message['text'].materialize())
+            encoded_message = json.dumps(message).encode('utf-8')
+            print(f"Sending message of size {len(encoded_message)} bytes")
+            shaped_sendall(client, encoded_message, buckets)
+        client.shutdown(socket.SHUT_WR)
+        try:
+            reply = _recv_all(client)
+        except (socket.timeout, ConnectionResetError):
+            return None
+        if not reply:
+            return None
+        try:
+            return json.loads(reply.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return None
+    finally:
+        client.close()
+
+def ping_frame(msg_id=None):
+    """Return an empty 'ping' frame, which peers with the 'ping' feature answer with a pong"""
+    header = {'type': 'ping', 'length': 0}
+    if msg_id is not None:
+        header['msg_id'] = msg_id
+    header = json.dumps(header).encode('utf-8')
+    return FRAME_MAGIC + struct.pack('!I', len(header)) + header
+
+def probe_peer(endpoint, local_interface=None, timeout=DEFAULT_TIMEOUT, ping=False):
+    """Measure the round trip time to a peer's listener in seconds.
+
+    With ping set the peer must have the 'ping' feature and the time to get
+    a pong is measured; otherwise it's the time to complete the TCP handshake.
+    Anything the pong advertises is passed on to endpoint.learn().
+    Raises OSError if the peer can't be reached.
+    """
+    start = time.monotonic()
+    client = endpoint.connect(local_interface, timeout)
+    try:
+        rtt = time.monotonic() - start
+        client.settimeout(timeout)
+        if ping:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            start = time.monotonic()
+            client.sendall(ping_frame())
+            reply = client.recv(4096)
+            if not reply:
+                raise ConnectionResetError("Peer closed the connection without answering the ping")
+            rtt = time.monotonic() - start
+            try:
+                endpoint.learn(json.loads(reply.split(b'\n', 1)[0].decode('utf-8')))
+            except ValueError:
+                pass
+        return rtt
+    finally:
+        client.close()
+
+class PeerHealth:
+    """Smoothed RTT and liveness of one peer.
+
+    RTT samples are smoothed like TCP does (RFC 6298) and the peer's connect
+    and read timeouts are derived from them. A peer is 'down' after
+    DOWN_AFTER_FAILURES consecutive failures and 'flapping' while it keeps
+    going up and down. on_change(device_id, state) is called from whichever
+    thread caused the state to change.
+    """
+
+    def __init__(self, device_id, on_change=None):
+        self.device_id = device_id
+        self.on_change = on_change
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        self.up = None  # None until the first probe or send
+        self.transitions = collections.deque()  # Times the peer went up or down
+        self._lock = threading.Lock()
+
+    def record_rtt(self, rtt):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.failures = 0
+        self._set_up(True)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            down = self.failures >= DOWN_AFTER_FAILURES
+        if down:
+            self._set_up(False)
+
+    def _set_up(self, up):
+        with self._lock:
+            if self.up == up:
+                return
+            before = self._state()
+            if self.up is not None:
+                self.transitions.append(time.monotonic())
+            self.up = up
+            after = self._state()
+        if after != before and self.on_change:
+            self.on_change(self.device_id, after)
+
+    def _state(self):
+        if self.up is None:
+            return 'unknown'
+        now = time.monotonic()
+        while self.transitions and now - self.transitions[0] > FLAP_WINDOW:
+            self.transitions.popleft()
+        if len(self.transitions) >= FLAP_TRANSITIONS:
+            return 'flapping'
+        return 'up' if self.up else 'down'
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def is_available(self):
+        """Whether clips should be sent to the peer right now"""
+        return self.state in ('unknown', 'up')
+
+    def _rto(self):
+        return self.srtt + max(0.01, 4 * self.rttvar)
+
+    def rto(self):
+        """Retransmission timeout for datagrams sent to the peer"""
+        with self._lock:
+            if self.srtt is None:
+                return UDP_INITIAL_RTO
+            return max(UDP_MIN_RTO, self._rto())
+
+    def _timeout(self, multiple, minimum):
+        with self._lock:
+            if self.srtt is None:
+                return DEFAULT_TIMEOUT
+            rto = self._rto()
+            # Back off like TCP's retransmission timer while the peer keeps failing
+            timeout = max(minimum, multiple * rto) * 2 ** min(self.failures, 3)
+            return min(timeout, DEFAULT_TIMEOUT)
+
+    def connect_timeout(self):
+        return self._timeout(3, MIN_CONNECT_TIMEOUT)
+
+    def read_timeout(self):
+        return self._timeout(4, MIN_READ_TIMEOUT)
+
+    def describe(self):
+        state = self.state
+        if state == 'unknown':
+            return "not probed yet"
+        if state == 'up' and self.srtt is not None:
+            return f"up, {self.srtt * 1000:.0f} ms"
+        return state
+
+class HeartbeatMonitor(threading.Thread):
+    """Probes every paired device each HEARTBEAT_INTERVAL seconds.
+
+    Probes run in parallel so an unreachable device doesn't delay the
+    others, and their results go into each device's PeerHealth.
+    """
+
+    def __init__(self, local_interface=None):
+        super().__init__(daemon=True, name='HeartbeatMonitor')
+        self.local_interface = local_interface
+        self.targets = {}  # device_id -> (PeerEndpoint, features, PeerHealth)
+        self.running = True
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def set_targets(self, targets):
+        """Replace the probed devices and probe any new ones right away"""
+        with self._lock:
+            new = set(targets) - set(self.targets)
+            self.targets = dict(targets)
+        if new:
+            self._wake.set()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def run(self):
+        while self.running:
+            self._wake.clear()
+            with self._lock:
+                targets = list(self.targets.items())
+            probes = [threading.Thread(target=self._probe, args=(device_id,) + target, daemon=True)
+                      for device_id, target in targets]
+            for probe in probes:
+                probe.start()
+            for probe in probes:
+                probe.join()
+            self._wake.wait(HEARTBEAT_INTERVAL)
+
+    def _probe(self, device_id, endpoint, features, health):
+        try:
+            rtt = probe_peer(endpoint, self.local_interface,
+                             timeout=health.connect_timeout(), ping='ping' in features)
+        except OSError as e:
+            if health.up is not False:
+                print(f"Health probe of {device_id} failed: {e}")
+            health.record_failure()
+            return
+        health.record_rtt(rtt)
+
+def plan_relay_tree(targets, fanout=RELAY_FANOUT):
+    """Split targets into at most fanout subtrees.
+
+    targets is a list of relay entries starting with [device_id, ip, features].
+    Each subtree is headed by a relay-capable peer which forwards to the rest
+    of its group; peers that can't relay only ever appear as leaves.
+    """
+    capable = [t for t in targets if 'relay' in t[2]]
+    if not capable:
+        return [(t, []) for t in targets]
+    heads = capable[:fanout]
+    groups = [(head, []) for head in heads]
+    rest = capable[fanout:] + [t for t in targets if 'relay' not in t[2]]
+    for i, target in enumerate(rest):
+        groups[i % len(heads)][1].append(target)
+    return groups
+
+def relay_text(sender_id, text, targets, port, local_interface=None, text_hash=None, seq=None,
+               health=None):
+    """Deliver text on behalf of sender_id to targets through a relay tree.
+
+    targets are relay list entries, port is used for entries that don't
+    carry one. Subtrees are delivered in parallel so a slow head only holds
+    up its own. health(device_id) may return the PeerHealth of a target:
+    heads that are down or flapping are skipped and the others get timeouts
+    derived from their RTT. If a subtree head can't be reached, its subtree
+    is delivered from here.
+    """
+    text_hash = text_hash or content_hash(text)
+    threads = [threading.Thread(target=_relay_subtree, daemon=True,
+                                args=(sender_id, text, entry, subtree, port, local_interface,
+                                      text_hash, seq, health))
+               for entry, subtree in plan_relay_tree(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def _relay_subtree(sender_id, text, entry, subtree, port, local_interface, text_hash, seq, health):
+    device_id, ip, features = entry[:3]
+    endpoint = relay_entry_endpoint(entry, port)
+    peer_health = health(device_id) if health else None
+    reply = None
+    if not endpoint.usable():
+        print(f"Skipping relay target {device_id} due to invalid interface")
+    elif peer_health and not peer_health.is_available():
+        print(f"Skipping relay target {device_id}, it is {peer_health.state}")
+    else:
+        message = {
+            'sender_id': sender_id,
+            'text': text,
+            'hash': text_hash
+        }
+        if seq is not None:
+            message['seq'] = seq
+        if subtree:
+            message['relay'] = relay_list_for(features, subtree)
+        timeouts = {}
+        if peer_health:
+            timeouts = {'timeout': peer_health.connect_timeout(), 'read_timeout': peer_health.read_timeout()}
+        try:
+            print(f"Relaying text from {sender_id} to {device_id} at {ip} ({len(subtree)} downstream)")
+            reply = send_message(endpoint, message, local_interface, framed='frame' in features, **timeouts)
+        except Exception as e:
+            print(f"Failed to relay text to {device_id}: {e}")
+            if peer_health:
+                peer_health.record_failure()
+    if subtree and not (reply and reply.get('status') == 'ok'):
+        relay_text(sender_id, text, subtree, port, local_interface, text_hash, seq, health)
+
+class BloomFilter:
+    """Set of strings with false positives but no false negatives.
+
+    Each summary uses a fresh salt, so an entry hidden by a false positive
+    in one history sync is found by the next one.
+    """
+
+    def __init__(self, size, hashes=HISTORY_BLOOM_HASHES, salt='', bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.salt = salt
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def build(cls, keys):
+        keys = list(keys)
+        bloom = cls(max(64, len(keys) * HISTORY_BLOOM_BITS), salt=os.urandom(8).hex())
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def _positions(self, key):
+        digest = hashlib.sha256((self.salt + key).encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(key))
+
+    def to_dict(self):
+        return {'size': self.size, 'hashes': self.hashes, 'salt': self.salt,
+                'bits': base64.b64encode(bytes(self.bits)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        bits = base64.b64decode(data['bits'])
+        if len(bits) != (data['size'] + 7) // 8:
+            raise ValueError("Bloom filter size doesn't match its bits")
+        return cls(data['size'], data['hashes'], data['salt'], bits)
+
+def history_entry_key(entry):
+    """Identify a history entry on every peer by its original sender and seq"""
+    return f"{entry['sender_id']}:{entry['seq']}"
+
+def _group_history(entries):
+    groups = {}
+    for entry in entries:
+        if entry.get('seq') is not None:
+            groups.setdefault(entry['sender_id'], []).append(entry)
+    return groups
+
+def _seq_digest(seqs):
+    return hashlib.sha256(','.join(map(str, sorted(seqs))).encode('ascii')).hexdigest()[:16]
+
+def history_summary(entries):
+    """Summarize history entries for a peer working out which ones we lack.
+
+    'vector' maps each original sender to [count, newest seq, digest of all
+    seqs], which is enough to skip senders whose entries match exactly and
+    to send everything newer than what we have. Older gaps, such as clips
+    missed while we were offline, are found through the Bloom filter of
+    every entry key. Entries without a seq, from before history sync
+    existed, stay local.
+    """
+    groups = _group_history(entries)
+    vector = {}
+    for sender_id, group in groups.items():
+        seqs = [entry['seq'] for entry in group]
+        vector[sender_id] = [len(seqs), max(seqs), _seq_digest(seqs)]
+    keys = (history_entry_key(entry) for group in groups.values() for entry in group)
+    return {'vector': vector, 'bloom': BloomFilter.build(keys).to_dict()}
+
+def missing_history(entries, summary, exclude=None, limit=HISTORY_SYNC_PAGE_SIZE):
+    """Return the entries missing from the history summarized by summary.
+
+    Entries from exclude, the requesting peer's own clips, are left out.
+    At most limit bytes of encoded entries are returned, oldest first,
+    along with whether more are missing.
+    """
+    vector = summary['vector']
+    bloom = BloomFilter.from_dict(summary['bloom'])
+    missing = []
+    for sender_id, group in _group_history(entries).items():
+        if sender_id == exclude:
+            continue
+        theirs = vector.get(sender_id)
+        if theirs and theirs[0] == len(group) and theirs[2] == _seq_digest(e['seq'] for e in group):
+            continue
+        newest = theirs[1] if theirs else -1
+        for entry in group:
+            # Anything newer than their newest entry from this sender is missing for sure
+            if entry['seq'] > newest or history_entry_key(entry) not in bloom:
+                missing.append(entry)
+
+    missing.sort(key=lambda entry: entry['seq'])
+    page, size = [], 0
+    for entry in missing:
+        if len(entry['text']) > limit:
+            continue
+        item = {key: entry[key] for key in ('sender_id', 'seq', 'timestamp')}
+        item['text'] = materialize(entry['text'])
+        item_size = len(json.dumps(item))
+        if item_size > limit:
+            continue
+        if size + item_size > limit:
+            return page, True
+        page.append(item)
+        size += item_size
+    return page, False
+
+def history_sync_key(passphrase):
+    """Derive the key signing history sync requests from the passphrase shared by a user's machines"""
+    return hashlib.pbkdf2_hmac('sha256', passphrase.encode('utf-8'), b'gweeb-history-sync', 100_000)
+
+def _history_request_mac(key, message):
+    unsigned = {name: value for name, value in message.items() if name != 'auth'}
+    return hmac.new(key, json.dumps(unsigned, sort_keys=True).encode('utf-8'), hashlib.sha256).hexdigest()
+
+def sign_history_request(key, message):
+    """Return message with a timestamp and a MAC proving we know the shared passphrase"""
+    message = dict(message, time=time.time())
+    message['auth'] = _history_request_mac(key, message)
+    return message
+
+def verify_history_request(key, message):
+    """Check that message was signed with key in the last HISTORY_SYNC_MAX_SKEW seconds"""
+    auth, timestamp = message.get('auth'), message.get('time')
+    if not isinstance(auth, str) or not isinstance(timestamp, (int, float)):
+        return False
+    if abs(time.time() - timestamp) > HISTORY_SYNC_MAX_SKEW:
+        return False
+    return hmac.compare_digest(auth, _history_request_mac(key, message))
+
+class HistorySync(threading.Thread):
+    """Pulls the history entries we are missing from peers with the 'history' feature.
+
+    Peers are synced one at a time, so entries fetched from one are already
+    part of the summary sent to the next and a machine catching up with a
+    whole fleet downloads each entry once. summarize() returns our current
+    history_summary() and merge(entries) adds fetched entries, returning how
+    many were new.
+
+    Requests are signed with key, derived from the passphrase the user
+    gave every machine (see history_sync_key()). Nothing is synced while
+    it is None.
+    """
+
+    def __init__(self, device_id, summarize, merge, local_interface=None):
+        super().__init__(daemon=True, name='HistorySync')
+        self.device_id = device_id
+        self.summarize = summarize
+        self.merge = merge
+        self.local_interface = local_interface
+        self.key = None
+        self.queue = collections.OrderedDict()  # device_id -> (PeerEndpoint, PeerHealth, attempt, due time)
+        self.condition = threading.Condition()
+        self.running = True
+
+    def request(self, device_id, endpoint, health, attempt=0, delay=0):
+        """Sync with device_id once the peers queued before it are done"""
+        with self.condition:
+            self.queue[device_id] = (endpoint, health, attempt, time.monotonic() + delay)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    now = time.monotonic()
+                    due = [device_id for device_id, item in self.queue.items() if item[3] <= now]
+                    if due:
+                        break
+                    waits = [item[3] - now for item in self.queue.values()]
+                    self.condition.wait(min(waits) if waits else None)
+                if not self.running:
+                    break
+                device_id = due[0]
+                endpoint, health, attempt, _ = self.queue.pop(device_id)
+            try:
+                self._sync(device_id, endpoint, health)
+            except (OSError, ValueError) as e:
+                if attempt >= HISTORY_SYNC_RETRIES:
+                    print(f"History sync with {device_id} failed: {e}")
+                    continue
+                delay = HISTORY_SYNC_RETRY_DELAY * 2 ** attempt
+                print(f"History sync with {device_id} failed, retrying in {delay}s: {e}")
+                with self.condition:
+                    if device_id not in self.queue:
+                        self.queue[device_id] = (endpoint, health, attempt + 1, time.monotonic() + delay)
+
+    def _sync(self, device_id, endpoint, health):
+        """Fetch pages of missing entries until the peer has nothing more for us.
+        Raises OSError if the peer can't be reached or doesn't reply."""
+        added = 0
+        while self.running:
+            key = self.key
+            if key is None:
+                return
+            message = sign_history_request(key, {'type': 'history_sync', 'sender_id': self.device_id,
+                                                 'summary': self.summarize()})
+            reply = send_message(endpoint, message, self.local_interface,
+                                 timeout=health.connect_timeout(), read_timeout=health.read_timeout())
+            if not reply:
+                raise ConnectionError(f"{device_id} didn't reply")
+            if reply.get('status') != 'ok':
+                print(f"{device_id} didn't share its history: {reply.get('status')}")
+                return
+            new = self.merge(reply['entries'])
+            added += new
+            if not reply.get('more') or not new:
+                break
+        print(f"History sync with {device_id} added {added} entries")
+
+def save_json(path, data):
+    """Write data to path as JSON without leaving a truncated file behind on failure"""
+    tmp_path = path + '.tmp'
+    try:
+        os.remove(tmp_path)  # A leftover could have looser permissions than O_CREAT would give
+    except FileNotFoundError:
+        pass
+    # History and outbox hold clipboard contents, which may be passwords, so only we may read them
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def load_json(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(f"Could not load {path}: {e}")
+        return default
+
+def is_record(entry, fields):
+    """Check that entry is a dict whose fields have the given types"""
+    return isinstance(entry, dict) and all(isinstance(entry.get(key), kind) for key, kind in fields.items())
+
+def control_server_name():
+    """Name of the local socket (a named pipe on Windows) a running instance
+    takes stop requests on. There is one per user."""
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = str(os.getuid()) if hasattr(os, 'getuid') else 'default'
+    return 'gweeb-control-' + ''.join(c if c.isalnum() else '_' for c in user)
+
+def request_stop(timeout=CONTROL_TIMEOUT):
+    """Ask the running instance to shut down through its control socket.
+    Returns False if no instance is listening on it."""
+    connection = QLocalSocket()
+    connection.connectToServer(control_server_name())
+    if not connection.waitForConnected(int(timeout * 1000)):
+        return False
+    connection.write(b'quit\n')
+    sent = connection.waitForBytesWritten(int(timeout * 1000))
+    connection.disconnectFromServer()
+    return sent
+
+def stop_process(pid, timeout=SHUTDOWN_TIMEOUT + 2):
+    """Ask a previous Gweeb instance to shut down, killing it if it doesn't in time"""
+    try:
+        process = psutil.Process(pid)
+        if pid == os.getpid() or 'gweeb' not in ' '.join(process.cmdline()).lower():
+            return  # The pid file is stale and the pid was reused
+        print(f"Stopping previous instance (pid {pid})...")
+        if not request_stop():
+            # Older instances don't take stop requests. On Windows terminate()
+            # kills outright, elsewhere the instance handles SIGTERM.
+            process.terminate()
+        process.wait(timeout)
+    except psutil.TimeoutExpired:
+        print(f"Previous instance did not stop within {timeout}s, killing it")
+        force_kill_process(pid)
+    except psutil.Error:
+        pass
 
 def force_kill_process(pid):
     """Force kill a process and all its children"""
@@ -130,25 +1449,236 @@ def force_kill_process(pid):
 def cleanup():
     global _cleanup_done
     if not _cleanup_done:
+        _cleanup_done = True
         print("\nPerforming cleanup...")
         if 'gweeb' in globals():
             try:
-                gweeb.force_quit()
-            except:
-                pass
-        
-        # Force kill our process and children
-        try:
-            force_kill_process(os.getpid())
-        except:
-            pass
-        _cleanup_done = True
+                gweeb.shutdown()
+            except Exception as e:
+                print(f"Error during shutdown: {e}")
+
+def _handle_exit_signal(signo, frame):
+    cleanup()
+    if 'gweeb' not in globals():
+        # Still starting up, there is no event loop to return from yet
+        os._exit(0)
 
 # Register cleanup handlers
 atexit.register(cleanup)
 if not IS_WINDOWS:
-    signal.signal(signal.SIGTERM, lambda signo, frame: cleanup())
-    signal.signal(signal.SIGINT, lambda signo, frame: cleanup())
+    signal.signal(signal.SIGTERM, _handle_exit_signal)
+    signal.signal(signal.SIGINT, _handle_exit_signal)
+
+class LogTail:
+    """Keeps the last LOG_TAIL_LINES lines written to sys.stdout and
+    sys.stderr so they can go into a diagnostics bundle. A tray app's output
+    usually goes nowhere, and under pythonw there is no stdout at all.
+    Tracebacks from Qt slots and threads are written to stderr."""
+
+    def __init__(self, limit=LOG_TAIL_LINES):
+        self.lines = collections.deque(maxlen=limit)
+        self._lock = threading.Lock()
+
+    def install(self):
+        sys.stdout = LogTailStream(self, sys.stdout)
+        sys.stderr = LogTailStream(self, sys.stderr)
+
+    def add(self, lines):
+        stamp = time.strftime('%H:%M:%S')
+        with self._lock:
+            self.lines.extend(f"{stamp} {line}" for line in lines)
+
+class LogTailStream:
+    """Stands in for one of the standard streams, passing output through and
+    adding complete lines to a LogTail"""
+
+    def __init__(self, tail, stream):
+        self.tail = tail
+        self.stream = stream
+        self._partial = ''
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        if self.stream:
+            self.stream.write(text)
+        with self._lock:
+            lines = (self._partial + text).split('\n')
+            self._partial = lines.pop()
+        self.tail.add(lines)
+        return len(text)
+
+    def flush(self):
+        if self.stream:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+LOG_TAIL = LogTail()
+
+def _thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+def format_thread_stacks():
+    """Return the current stack of every thread as text"""
+    names = _thread_names()
+    parts = []
+    for ident, frame in sys._current_frames().items():
+        parts.append(f"Thread {names.get(ident, 'unknown')} ({ident}):\n"
+                     + ''.join(traceback.format_stack(frame)))
+    return '\n'.join(parts)
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of all threads every PROFILE_SAMPLE_INTERVAL seconds.
+
+    cProfile only sees the thread it was enabled on, so this is what shows
+    where the listener and connection threads spend their time. Samples are
+    written in the folded format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        super().__init__(daemon=True, name='StackSampler')
+        self.interval = interval
+        self.counts = collections.Counter()  # (thread name, frame, ...) -> samples
+        self.samples = 0
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            names = _thread_names()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f'thread-{ident}'))
+                self.counts[tuple(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.most_common():
+                f.write(';'.join(frame.replace(';', ',') for frame in stack) + f" {count}\n")
+
+class Diagnostics:
+    """Profiles, memory snapshots and diagnostics bundles, all written to directory.
+
+    Profiling runs cProfile on the GUI thread, saved as .pstats, and a
+    StackSampler over every thread. Memory snapshots start tracemalloc on
+    first use; later ones report what grew since the previous snapshot.
+    state() returns whatever the application wants in reports, such as the
+    size of its history and clipboard copies.
+    """
+
+    def __init__(self, directory, state=None):
+        self.directory = directory
+        self.state = state or dict
+        self.profiler = None
+        self.sampler = None
+        self._profile_started = None
+        self._snapshot = None
+
+    @property
+    def profiling(self):
+        return self.profiler is not None
+
+    def _path(self, prefix, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+    def start_profile(self):
+        """Start profiling, must be called on the GUI thread"""
+        if self.profiler:
+            return
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler()
+        self._profile_started = time.monotonic()
+        self.sampler.start()
+        self.profiler.enable()
+        print("Profiling started")
+
+    def stop_profile(self):
+        """Stop profiling and write the results. Returns the paths written."""
+        if not self.profiler:
+            return []
+        self.profiler.disable()
+        self.sampler.stop()
+        profile_path = self._path('profile', 'pstats')
+        self.profiler.dump_stats(profile_path)
+        samples_path = self._path('samples', 'folded')
+        self.sampler.write(samples_path)
+        print(f"Profiled {time.monotonic() - self._profile_started:.1f}s with {self.sampler.samples} "
+              f"stack samples, written to {profile_path} and {samples_path}")
+        self.profiler = self.sampler = None
+        return [profile_path, samples_path]
+
+    def take_memory_snapshot(self):
+        """Write a report of the largest allocations and of what grew since
+        the previous snapshot. Returns its path."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._snapshot = None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Traced memory: {current / 1024 / 1024:.1f} MiB (peak {peak / 1024 / 1024:.1f} MiB)", "",
+                 "Application state:"]
+        lines += [f"  {key}: {value}" for key, value in self.state().items()]
+        if self._snapshot is None:
+            lines += ["", "Tracing started with this snapshot, take another one to see what grows."]
+        else:
+            lines += ["", f"Top {MEMORY_REPORT_TOP} changes since the previous snapshot:"]
+            lines += [f"  {stat}" for stat in snapshot.compare_to(self._snapshot, 'lineno')[:MEMORY_REPORT_TOP]]
+        lines += ["", f"Top {MEMORY_REPORT_TOP} allocation sites:"]
+        for stat in snapshot.statistics('traceback')[:MEMORY_REPORT_TOP]:
+            lines.append(f"  {stat.size / 1024:.1f} KiB in {stat.count} blocks")
+            lines += [f"    {line}" for line in stat.traceback.format()]
+        self._snapshot = snapshot
+
+        path = self._path('memory', 'txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        print(f"Memory snapshot written to {path}")
+        return path
+
+    def write_bundle(self):
+        """Write thread stacks, timing counters, application state and recent
+        output to a zip file for offline analysis. Returns its path."""
+        path = self._path('gweeb-diagnostics', 'zip')
+        info = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform': platform.platform(),
+            'python': sys.version,
+            'pid': os.getpid(),
+            'threads': len(threading.enumerate()),
+            'profiling': self.profiling,
+            'tracing_memory': tracemalloc.is_tracing(),
+            'state': self.state(),
+        }
+        try:
+            process = psutil.Process()
+            info['cpu_times'] = process.cpu_times()._asdict()
+            info['rss_bytes'] = process.memory_info().rss
+        except Exception as e:
+            info['process_error'] = str(e)
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr('stacks.txt', format_thread_stacks())
+            bundle.writestr('timings.json', json.dumps(TIMINGS.snapshot(), indent=2))
+            bundle.writestr('info.json', json.dumps(info, indent=2, default=str))
+            bundle.writestr('log.txt', '\n'.join(LOG_TAIL.lines) + '\n')
+        print(f"Diagnostics bundle written to {path}")
+        return path
 
 def show_linux_notification(title, message, timeout=2000):
     """Show a notification using Linux's notification system"""
@@ -200,7 +1730,7 @@ def create_icon():
     return QIcon(QPixmap.fromImage(img))
 
 class DeviceDiscovery(QObject):
-    device_found = Signal(str, str, str)  # device_id, ip_address, interface_ip
+    device_found = Signal(str, str, str, object, object)  # device_id, ip_address, interface_ip, features, PeerEndpoint
     device_removed = Signal(str)  # device_id
 
     def __init__(self):
@@ -211,22 +1741,26 @@ def __init__(self):
         self.local_ip = None
         self.hostname = socket.gethostname()  # Store full hostname for display
         
-    def start_advertising(self, device_id, port):
+    def start_advertising(self, device_id, port, addresses=None):
+        """Advertise our service with addresses, the first of which is the
+        primary interface; defaults to just the local IP"""
         # Get local IP
         self.local_ip = get_local_ip()
+        addresses = addresses or [self.local_ip]
         if not is_valid_interface(self.local_ip):
             print(f"Warning: Using non-zerotier interface: {self.local_ip}")
-        print(f"Advertising as {device_id} ({self.hostname}) on interface: {self.local_ip}")
+        print(f"Advertising as {device_id} ({self.hostname}) on interface: {self.local_ip}, addresses: {', '.join(addresses)}")
         
         self.info = ServiceInfo(
             "_cliphop._tcp.local.",
             f"{device_id}._cliphop._tcp.local.",
-            addresses=[socket.inet_aton(self.local_ip)],
+            addresses=[socket.inet_pton(socket.AF_INET6 if ':' in a else socket.AF_INET, a) for a in addresses],
             port=port,
             properties={
                 b'device_id': device_id.encode('utf-8'),
                 b'hostname': self.hostname.encode('utf-8'),  # Include full hostname
-                b'interface': self.local_ip.encode('utf-8')
+                b'interface': self.local_ip.encode('utf-8'),
+                b'features': ','.join(PROTOCOL_FEATURES).encode('utf-8')
             }
         )
         self.zeroconf.register_service(self.info)
@@ -243,13 +1777,17 @@ def _on_service_state_change(self, zeroconf, service_type, name, state_change):
                     device_id = info.properties[b'device_id'].decode('utf-8')
                     hostname = info.properties.get(b'hostname', b'Unknown').decode('utf-8')
                     remote_interface = info.properties[b'interface'].decode('utf-8')
+                    features = info.properties.get(b'features') or b''
+                    features = [f for f in features.decode('utf-8').split(',') if f]
                     if device_id:
-                        ip = socket.inet_ntoa(info.addresses[0])
+                        # Keep every advertised address, IPv4 and IPv6, along with the port
+                        endpoint = PeerEndpoint(info.parsed_scoped_addresses(), info.port)
+                        ip = endpoint.address
                         if not is_valid_interface(ip):
                             print(f"Warning: Device {device_id} ({hostname}) using non-zerotier interface: {ip}")
                         print(f"Found device {device_id} ({hostname}) at {ip} (interface: {remote_interface})")
                         if is_valid_interface(ip) and is_valid_interface(remote_interface):
-                            self.device_found.emit(device_id, ip, remote_interface)
+                            self.device_found.emit(device_id, ip, remote_interface, features, endpoint)
                         else:
                             print(f"Ignoring device {device_id} ({hostname}) due to invalid interface")
                 except (KeyError, IndexError, AttributeError) as e:
@@ -273,74 +1811,637 @@ def stop(self):
         except:
             pass
 
-class NetworkListener(QThread):
-    text_received = Signal(str, str)  # sender_id, text
+class NetworkListener(QThread):
+    text_received = Signal(str, object, bool, object)  # sender_id, text (str or SpilledText), is newest from sender, seq
+
+    def __init__(self, port=5555):
+        super().__init__()
+        self.interface_ip = get_local_ip()
+        if not is_valid_interface(self.interface_ip):
+            print(f"Warning: Network listener using non-zerotier interface: {self.interface_ip}")
+        self.port = self._find_available_port(port)
+        self.addresses = get_local_addresses(self.interface_ip)  # Advertised to peers, accepted on each
+        self.running = True
+        self.server = None
+        self._wake_r, self._wake_w = socket.socketpair()  # Written to by stop() to wake the accept loop
+        self._connections = set()  # Sockets of connections being served
+        self.datagram_info = None  # Port and key of our DatagramChannel, handed out in pongs
+        self.history_source = None  # Answers history sync requests, None while history sync is off
+        self.peer_health = None  # device_id -> PeerHealth or None, used when relaying
+        self.last_texts = {}  # sender_id -> (hash, text), base for delta messages
+        self.latest_seq = {}  # sender_id -> seq of the newest clip received
+        self._lock = threading.Lock()
+        _clear_stale_spill_dirs()
+        print(f"Network listener starting on {self.interface_ip}:{self.port}")
+
+    def _find_available_port(self, start_port):
+        port = start_port
+        while port < start_port + 100:  # Try up to 100 ports
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.bind((self.interface_ip, port))
+                    return port
+            except OSError:
+                port += 1
+        raise RuntimeError("Could not find an available port")
+
+    def run(self):
+        threading.current_thread().name = 'NetworkListener'  # Shown in profiles and thread stacks
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.server.bind((self.interface_ip, self.port))
+            print(f"Successfully bound to {self.interface_ip}:{self.port}")
+        except Exception as e:
+            print(f"Failed to bind to {self.interface_ip}:{self.port}: {e}")
+            return
+
+        self.server.settimeout(1)  # 1 second timeout for accept()
+        self.server.listen(LISTEN_BACKLOG)
+        servers = [self.server]
+        # Peers race every address we advertise, so accept on all of them
+        for address in self.addresses[1:]:
+            server = socket.socket(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                server.bind((address, self.port))
+                server.settimeout(1)
+                server.listen(LISTEN_BACKLOG)
+                servers.append(server)
+                print(f"Also listening on {address}:{self.port}")
+            except OSError as e:
+                print(f"Failed to bind to {address}:{self.port}: {e}")
+                server.close()
+        print("Server is listening for connections")
+        
+        while self.running:
+            try:
+                # Wait for a connection or for stop() to wake us up
+                readable, _, _ = select.select(servers + [self._wake_r], [], [])
+            except Exception as e:
+                if self.running:
+                    print(f"Error in network listener: {e}")
+                continue
+            for server in readable:
+                if server is self._wake_r:
+                    continue
+                try:
+                    client, addr = server.accept()
+                except socket.timeout:
+                    continue
+                except Exception as e:
+                    if self.running:  # Only print error if we're still supposed to be running
+                        print(f"Error in network listener: {e}")
+                    continue
+                print(f"Accepted connection from {addr}")
+                threading.Thread(target=self._serve_connection, args=(client,), daemon=True,
+                                 name=f"Connection {addr[0]}").start()
+        for server in servers:
+            server.close()
+
+    def _serve_connection(self, client):
+        """Handle every message on one connection until the sender closes it.
+
+        Peers with the 'stream' feature keep the connection open and interleave
+        chunks of several messages, so each connection gets its own thread.
+        """
+        assembler = MessageAssembler()
+        with self._lock:
+            self._connections.add(client)
+        try:
+            client.settimeout(PEER_IDLE_TIMEOUT)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Once stopped, only finish messages that are partly received
+            while self.running or assembler.partial:
+                try:
+                    header, body = read_frame(client)
+                    if header is None:
+                        break
+                    if body is None:
+                        # Unframed messages are always alone on their connection
+                        message = header
+                    else:
+                        message = assembler.add(header, body)
+                        if message is None:
+                            continue
+                    if message.get('type') == 'ping':
+                        reply = {'status': 'pong'}
+                        if self.datagram_info:
+                            reply.update(self.datagram_info)
+                    elif message.get('type') == 'history_sync':
+                        source = self.history_source
+                        address = client.getpeername()[0]
+                        reply = source(message, address) if source else {'status': 'disabled'}
+                    else:
+                        print(f"Received message from {message.get('sender_id', 'unknown')}")
+                        reply = self.handle_message(message)
+                except (UnicodeDecodeError, json.JSONDecodeError, KeyError) as e:
+                    print(f"Failed to decode message: {e}")
+                    break
+                if 'msg_id' in message:
+                    reply['msg_id'] = message['msg_id']
+                client.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except Exception as e:
+            if self.running:
+                print(f"Error in network listener: {e}")
+        finally:
+            with self._lock:
+                self._connections.discard(client)
+            assembler.abort()
+            client.close()
+
+    @timed('receive_message')
+    def handle_message(self, message):
+        """Rebuild the text carried by a message and emit it. Returns the reply for the sender."""
+        sender_id = message['sender_id']
+        if 'delta' in message:
+            with self._lock:
+                base = self.last_texts.get(sender_id)
+            if not base or base[0] != message['delta']['base']:
+                print(f"Missing delta base for {sender_id}, asking for a full send")
+                return {'status': 'need_base'}
+            text = apply_delta(base[1], message['delta'])
+        else:
+            text = message['text']
+
+        text_hash = content_hash(text)
+        if message.get('hash', text_hash) != text_hash:
+            print(f"Hash mismatch for text from {sender_id}, asking for a full send")
+            with self._lock:
+                self.last_texts.pop(sender_id, None)
+            return {'status': 'need_base'}
+
+        # A bulk clip can finish after a newer interactive one from the same
+        # sender; it still goes to the history but must not replace the newer clip
+        seq = message.get('seq')
+        with self._lock:
+            self.last_texts[sender_id] = (text_hash, text)
+            latest = seq is None or seq >= self.latest_seq.get(sender_id, 0)
+            if seq is not None and latest:
+                self.latest_seq[sender_id] = seq
+        self.text_received.emit(sender_id, text, latest, seq)
+
+        # Pass the clip on to the part of the relay tree we are responsible for
+        relay_targets = message.get('relay')
+        if relay_targets:
+            threading.Thread(
+                target=relay_text,
+                args=(sender_id, text, relay_targets, self.port, self.interface_ip, text_hash, seq,
+                      self.peer_health),
+                daemon=True
+            ).start()
+        return {'status': 'ok', 'hash': text_hash}
+
+    def stop(self):
+        """Stop accepting connections. Connections being served finish the
+        message they are receiving, see close_connections()."""
+        self.running = False
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def close_connections(self):
+        """Cut off every connection still being served"""
+        with self._lock:
+            connections = list(self._connections)
+        for client in connections:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def _seal(key, body):
+    return UDP_MAGIC + hmac.new(key, UDP_MAGIC + body, hashlib.sha256).digest() + body
+
+def _unseal(key, datagram):
+    """Return the body of a datagram sealed with key, or None if it wasn't"""
+    mac, body = datagram[len(UDP_MAGIC):len(UDP_MAGIC) + 32], datagram[len(UDP_MAGIC) + 32:]
+    expected = hmac.new(key, UDP_MAGIC + body, hashlib.sha256).digest()
+    return body if hmac.compare_digest(mac, expected) else None
+
+class DatagramChannel(threading.Thread):
+    """Delivers small messages in single UDP datagrams, next to the TCP listener.
+
+    Datagrams in both directions carry an HMAC keyed with the receiver's
+    random key, which peers only learn from our pongs over TCP, so a
+    datagram is only accepted from a peer that could have sent us the same
+    message over TCP. Messages are acknowledged and retransmitted after the
+    peer's RTO, up to UDP_RETRIES times, before on_fail lets the caller fall
+    back to TCP.
+    """
+
+    def __init__(self, listener):
+        super().__init__(daemon=True, name='DatagramChannel')
+        self.listener = listener
+        self.key = os.urandom(16)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind((listener.interface_ip, listener.port))
+        except OSError:
+            self.sock.close()
+            raise
+        self.running = True
+        self._pending = {}  # msg_id -> [datagram, address, key, callback, on_fail, rto, tries, resend_at]
+        self._lock = threading.Lock()
+        self._handled = collections.OrderedDict()  # (sender_id, msg_id) -> ack, to answer retransmits
+        self._wake_r, self._wake_w = socket.socketpair()
+
+    @property
+    def info(self):
+        return {'udp_port': self.sock.getsockname()[1], 'udp_key': self.key.hex()}
+
+    def send(self, address, key, message, callback, on_fail, rto):
+        """Send message to address, a (host, port) tuple. Returns False if it doesn't fit in a datagram.
+
+        callback(reply) or on_fail() is called from the channel's thread.
+        """
+        msg_id = random.getrandbits(63)
+        datagram = _seal(key, json.dumps(dict(message, msg_id=msg_id)).encode('utf-8'))
+        if len(datagram) > UDP_MAX_DATAGRAM:
+            return False
+        with self._lock:
+            self._pending[msg_id] = [datagram, address, key, callback, on_fail, rto, 0,
+                                     time.monotonic() + rto]
+        self._sendto(datagram, address)
+        self._wake_w.send(b'x')  # The next retransmission may now be due sooner
+        return True
+
+    def stop(self):
+        self.running = False
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def _sendto(self, datagram, address):
+        try:
+            self.sock.sendto(datagram, address)
+        except OSError as e:
+            print(f"Failed to send datagram to {address[0]}: {e}")
+
+    def run(self):
+        while self.running:
+            try:
+                self._poll()
+            except Exception as e:
+                # Datagrams come from anyone on the network, none of them may end this thread
+                print(f"Error in datagram channel: {e}")
+        self.sock.close()
+
+    def _poll(self):
+        with self._lock:
+            resend_times = [entry[7] for entry in self._pending.values()]
+        timeout = max(0, min(resend_times) - time.monotonic()) if resend_times else None
+        readable, _, _ = select.select([self.sock, self._wake_r], [], [], timeout)
+        if self._wake_r in readable:
+            self._wake_r.recv(4096)
+        if self.sock in readable:
+            try:
+                datagram, address = self.sock.recvfrom(65536)
+            except OSError:
+                # Windows reports ICMP port unreachable for earlier sends here
+                datagram = None
+            if datagram and datagram.startswith(UDP_MAGIC):
+                try:
+                    self._handle(datagram, address)
+                except (UnicodeDecodeError, ValueError, KeyError, TypeError) as e:
+                    print(f"Failed to decode datagram from {address[0]}: {e}")
+        self._retransmit()
+
+    def _handle(self, datagram, address):
+        body = _unseal(self.key, datagram)
+        if body is None:
+            # Not for us, so it may be an ack sealed with the key of the peer we sent to
+            message = json.loads(datagram[len(UDP_MAGIC) + 32:].decode('utf-8'))
+            if not isinstance(message, dict):
+                raise ValueError("Datagram payload is not an object")
+            with self._lock:
+                entry = self._pending.get(message.get('msg_id'))
+                if not entry or message.get('type') != 'ack' or _unseal(entry[2], datagram) is None:
+                    return
+                del self._pending[message['msg_id']]
+            entry[3](message)
+            return
+
+        message = json.loads(body.decode('utf-8'))
+        if not isinstance(message, dict):
+            raise ValueError("Datagram payload is not an object")
+        handled_key = (message['sender_id'], message['msg_id'])
+        ack = self._handled.get(handled_key)
+        if ack is None:
+            print(f"Received datagram from {message['sender_id']}")
+            ack = self.listener.handle_message(message)
+            ack.update(type='ack', msg_id=message['msg_id'])
+            self._handled[handled_key] = ack
+            while len(self._handled) > 1024:
+                self._handled.popitem(last=False)
+        self._sendto(_seal(self.key, json.dumps(ack).encode('utf-8')), address)
+
+    def _retransmit(self):
+        now = time.monotonic()
+        failed = []
+        with self._lock:
+            for msg_id, entry in list(self._pending.items()):
+                if entry[7] > now:
+                    continue
+                if entry[6] >= UDP_RETRIES:
+                    del self._pending[msg_id]
+                    failed.append(entry[4])
+                    continue
+                entry[6] += 1
+                entry[5] *= 2
+                entry[7] = now + entry[5]
+                self._sendto(entry[0], entry[1])
+        for on_fail in failed:
+            on_fail()
+
+class PeerSender(threading.Thread):
+    """Queued delivery to one peer with an interactive and a bulk lane.
 
-    def __init__(self, port=5555):
-        super().__init__()
-        self.interface_ip = get_local_ip()
-        if not is_valid_interface(self.interface_ip):
-            print(f"Warning: Network listener using non-zerotier interface: {self.interface_ip}")
-        self.port = self._find_available_port(port)
+    Peers advertising 'stream' get a persistent connection. Bulk messages are
+    split into CHUNK_SIZE frames and queued interactive messages are written
+    between chunks, so a short clip never waits for a whole large one. Other
+    peers get one connection per message, interactive lane first.
+
+    Writes are rate limited by bucket. During bulk transfers to peers with the
+    'ping' feature, small probes measure RTT, and when adaptive is set the
+    bucket's rate is lowered as soon as RTT climbs above its baseline.
+    Timeouts come from health, which also records RTT samples and failures.
+
+    When datagrams is set and the peer handed out its datagram key, messages
+    small enough for one datagram skip the queues and go over UDP, falling
+    back to the TCP lanes if they aren't acknowledged.
+    """
+
+    def __init__(self, device_id, endpoint, local_interface=None, features=(), bucket=None,
+                 health=None):
+        super().__init__(daemon=True, name=f'PeerSender {device_id}')
+        self.device_id = device_id
+        self.endpoint = endpoint
+        self.local_interface = local_interface
+        self.features = set(features)
+        self.interactive = collections.deque()
+        self.bulk = collections.deque()
+        self.condition = threading.Condition()
         self.running = True
-        self.server = None
-        print(f"Network listener starting on {self.interface_ip}:{self.port}")
+        self.sock = None
+        self._bulk_frames = None  # Remaining frames of the bulk message being sent
+        self._next_msg_id = 1
+        self._pending = {}  # msg_id -> callback waiting for the reply
+        self._pending_lock = threading.Lock()
+        self._last_activity = time.time()
+        self.bucket = bucket
+        self.health = health or PeerHealth(device_id)
+        self.datagrams = None  # DatagramChannel for the UDP fast path
+        self.adaptive = True
+        self.base_rtt = None
+        self._ping_sent_at = None
+        self._last_ping = 0
+        self._bytes_written = 0
+        self._last_rate_sample = (time.monotonic(), 0)
 
-    def _find_available_port(self, start_port):
-        port = start_port
-        while port < start_port + 100:  # Try up to 100 ports
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.bind((self.interface_ip, port))
-                    return port
-            except OSError:
-                port += 1
-        raise RuntimeError("Could not find an available port")
+    def send(self, message, callback=None):
+        """Queue a message. callback(reply) is called from a network thread,
+        with None if the peer could not be reached or didn't reply."""
+        if not self._send_datagram(message, callback):
+            self._queue(message, callback)
+
+    def _send_datagram(self, message, callback):
+        datagrams, peer = self.datagrams, self.endpoint.datagram
+        if not datagrams or not peer or message_size(message) > UDP_MAX_DATAGRAM:
+            return False
+        # Our datagram socket is IPv4 only
+        address = next((a for a in self.endpoint.usable() if ':' not in a), None)
+        if address is None:
+            return False
+
+        def on_fail():
+            print(f"No datagram ack from {self.device_id}, falling back to TCP")
+            # The peer may have restarted with a new key, use TCP until its next pong
+            self.endpoint.datagram = None
+            self._queue(message, callback)
+
+        return datagrams.send((address, peer[0]), peer[1], message,
+                              callback, on_fail, self.health.rto())
+
+    def _queue(self, message, callback):
+        lane = self.interactive if message_size(message) <= INTERACTIVE_MAX_SIZE else self.bulk
+        with self.condition:
+            if self.running:
+                lane.append((message, callback))
+                self.condition.notify()
+                return
+        # A stopped sender will never get to it
+        if callback:
+            callback(None)
+
+    def take_queued(self):
+        """Remove and return the (message, callback) items not yet started"""
+        with self.condition:
+            items = list(self.interactive) + list(self.bulk)
+            self.interactive.clear()
+            self.bulk.clear()
+        return items
+
+    def stop(self):
+        """Stop sending. Callbacks of messages still queued or in flight get None."""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
 
     def run(self):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        while True:
+            with self.condition:
+                while self.running and not (self.interactive or self.bulk or self._bulk_frames):
+                    self.condition.wait(timeout=SENDER_IDLE_CLOSE)
+                    if (self.sock and not self._pending
+                            and time.time() - self._last_activity > SENDER_IDLE_CLOSE):
+                        print(f"Closing idle connection to {self.device_id}")
+                        self._disconnect()
+                if not self.running:
+                    break
+                if self.interactive:
+                    lane, item = 'interactive', self.interactive.popleft()
+                elif self._bulk_frames is None:
+                    lane, item = 'bulk', self.bulk.popleft()
+                else:
+                    lane, item = 'bulk', None  # Next chunk of the current bulk message
+
+            if 'stream' in self.features:
+                self._send_stream(lane, item)
+            else:
+                self._send_single(item)
+        self._disconnect()
+        for message, callback in self.take_queued():
+            if callback:
+                callback(None)
+
+    def _send_single(self, item):
+        message, callback = item
+        reply = None
         try:
-            self.server.bind((self.interface_ip, self.port))
-            print(f"Successfully bound to {self.interface_ip}:{self.port}")
+            reply = send_message(self.endpoint, message, self.local_interface,
+                                 timeout=self.health.connect_timeout(), framed='frame' in self.features,
+                                 read_timeout=self.health.read_timeout())
         except Exception as e:
-            print(f"Failed to bind to {self.interface_ip}:{self.port}: {e}")
+            print(f"Failed to send to {self.device_id}: {e}")
+            self.health.record_failure()
+        if callback:
+            callback(reply)
+
+    def _write(self, header, body):
+        _write_raw_frame(self.sock, header, body, (self.bucket,))
+        self._bytes_written += len(body)
+
+    def _send_stream(self, lane, item):
+        registered = False
+        try:
+            if item is not None:
+                if not self.sock:
+                    self._connect()
+                message, callback = item
+                msg_id = self._next_msg_id
+                self._next_msg_id += 1
+                with self._pending_lock:
+                    self._pending[msg_id] = callback
+                registered = True
+                frames = iter_chunk_frames(msg_id, message)
+                if lane == 'interactive':
+                    for header, body in frames:
+                        self._write(header, body)
+                else:
+                    print(f"Starting bulk transfer of {message_size(message)} bytes to {self.device_id}")
+                    self._bulk_frames = frames
+
+            if lane == 'bulk':
+                self._maybe_ping()
+                header, body = next(self._bulk_frames)
+                self._write(header, body)
+                if not header['more']:
+                    self._bulk_frames = None
+            self._last_activity = time.time()
+        except Exception as e:
+            print(f"Failed to send to {self.device_id}: {e}")
+            self.health.record_failure()
+            if item is not None and not registered:
+                # Never connected, so the message isn't in _pending yet
+                message, callback = item
+                if callback:
+                    callback(None)
+            self._disconnect()
+
+    def _maybe_ping(self):
+        now = time.monotonic()
+        if ('ping' not in self.features or self._ping_sent_at is not None
+                or now - self._last_ping < PING_INTERVAL):
             return
+        msg_id = self._next_msg_id
+        self._next_msg_id += 1
+        self._ping_sent_at = self._last_ping = now
+        with self._pending_lock:
+            self._pending[msg_id] = self._on_pong
+        # Probes skip the token buckets so they only measure network queueing
+        self.sock.sendall(ping_frame(msg_id))
 
-        self.server.settimeout(1)  # 1 second timeout for accept()
-        self.server.listen(5)
-        print("Server is listening for connections")
-        
-        while self.running:
-            try:
-                client, addr = self.server.accept()
-                print(f"Accepted connection from {addr}")
-                data = client.recv(1024*1024).decode('utf-8')  # Support up to 1MB of text
-                if data:
-                    try:
-                        message = json.loads(data)
-                        print(f"Received message from {message.get('sender_id', 'unknown')}")
-                        self.text_received.emit(message['sender_id'], message['text'])
-                    except json.JSONDecodeError as e:
-                        print(f"Failed to decode message: {e}")
-                client.close()
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:  # Only print error if we're still supposed to be running
-                    print(f"Error in network listener: {e}")
+    def _on_pong(self, reply):
+        sent_at, self._ping_sent_at = self._ping_sent_at, None
+        if not reply or sent_at is None:
+            return
+        now = time.monotonic()
+        rtt = now - sent_at
+        last_time, last_bytes = self._last_rate_sample
+        throughput = (self._bytes_written - last_bytes) / max(now - last_time, 1e-6)
+        self._last_rate_sample = (now, self._bytes_written)
+        self.endpoint.learn(reply)
+        self.health.record_rtt(rtt)
+        self._on_rtt_sample(rtt, throughput)
 
-    def stop(self):
-        self.running = False
-        if self.server:
+    def _on_rtt_sample(self, rtt, throughput):
+        self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt, rtt)
+        bucket = self.bucket
+        if not self.adaptive or not bucket:
+            return
+        if rtt > self.base_rtt * RTT_BACKOFF_FACTOR and rtt - self.base_rtt > RTT_QUEUE_TARGET:
+            # Our own bulk data is queueing somewhere, slow down multiplicatively
+            current = bucket.rate if bucket.rate is not None else throughput
+            rate = max(MIN_ADAPTIVE_RATE, current * 0.7)
+            print(f"RTT to {self.device_id} rose to {rtt * 1000:.0f} ms, backing off to {format_rate(rate)}")
+            bucket.set_rate(rate)
+        elif bucket.rate is not None and bucket.rate != bucket.limit:
+            rate = bucket.rate * 1.1
+            if bucket.limit is None and rate > throughput * 1.5:
+                rate = None  # The backoff limit is no longer what holds us back
+            bucket.set_rate(rate)
+
+    def _connect(self):
+        print(f"Opening persistent connection to {self.device_id} at {self.endpoint.address}:{self.endpoint.port}")
+        start = time.monotonic()
+        sock = self.endpoint.connect(self.local_interface, self.health.connect_timeout())
+        try:
+            self.health.record_rtt(time.monotonic() - start)
+            # A small send buffer keeps queued bulk data from delaying interactive clips,
+            # and Nagle would hold back small frames written right after a chunk
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SNDBUF)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(PEER_IDLE_TIMEOUT)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self.base_rtt = None
+        threading.Thread(target=self._read_replies, args=(sock,), daemon=True).start()
+
+    def _disconnect(self):
+        sock, self.sock = self.sock, None
+        self._bulk_frames = None
+        self._ping_sent_at = None
+        if sock:
             try:
-                self.server.close()
-            except:
+                sock.close()
+            except OSError:
                 pass
+        self._fail_pending()
+
+    def _fail_pending(self):
+        with self._pending_lock:
+            callbacks = list(self._pending.values())
+            self._pending.clear()
+        for callback in callbacks:
+            if callback:
+                callback(None)
+
+    def _read_replies(self, sock):
+        buffer = b''
+        try:
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                buffer += data
+                while b'\n' in buffer:
+                    line, buffer = buffer.split(b'\n', 1)
+                    reply = json.loads(line.decode('utf-8'))
+                    with self._pending_lock:
+                        callback = self._pending.pop(reply.get('msg_id'), None)
+                    if callback:
+                        callback(reply)
+        except (OSError, ValueError):
+            pass
+        if sock is self.sock:
+            print(f"Connection to {self.device_id} closed by peer")
+            with self.condition:
+                self._disconnect()
 
 class SendTextDialog(QWidget):
+    send_finished = Signal(bool)  # Emitted from a network thread with whether the device acknowledged the text
+
     def __init__(self, parent=None, target_id=None, port=5555, device_id=None, devices=None):
         super().__init__()  # Initialize without parent
+        self.send_finished.connect(self.handle_send_finished)
         self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.Window)  # Set window flags after initialization
         self.setWindowTitle(f"Send Text to {target_id}")
         self.port = port
@@ -349,6 +2450,11 @@ def __init__(self, parent=None, target_id=None, port=5555, device_id=None, devic
         ip, _ = devices.get(target_id, (None, None))  # Get IP for target device
         self.target_ip = ip
         self._parent_ref = parent  # Keep a reference to parent object
+        # Send to the port the device advertised, which needn't match ours
+        self.endpoint = PeerEndpoint([ip], port)
+        if ip and hasattr(parent, 'get_peer_endpoint'):
+            self.endpoint = parent.get_peer_endpoint(target_id, ip)
+            self.port = self.endpoint.port
         self.setup_ui()
 
     def setup_ui(self):
@@ -403,45 +2509,22 @@ def send_text(self):
             return
             
         print(f"Attempting to send text to {self.target_id} at {self.target_ip}:{self.port}")
-            
-        try:
-            # Create socket bound to the correct interface
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if hasattr(self._parent_ref, 'listener'):
-                local_interface = self._parent_ref.listener.interface_ip
-                if not is_valid_interface(local_interface):
-                    print(f"Warning: Local interface {local_interface} is not valid, attempting to find zerotier interface")
-                    local_interface = get_local_ip()
-                    if not is_valid_interface(local_interface):
-                        QMessageBox.warning(self, "Error", "Could not find valid zerotier interface")
-                        return
-                
-                local_addr = (local_interface, 0)
-                client.bind(local_addr)
-                print(f"Bound client to local interface: {local_addr[0]}")
-            
-            client.settimeout(5)
-            print(f"Connecting to {self.target_ip}:{self.port}...")
-            client.connect((self.target_ip, self.port))
-            print("Connected successfully")
-            
-            message = {
-                'sender_id': self.device_id,
-                'text': text
-            }
-            encoded_message = json.dumps(message).encode('utf-8')
-            print(f"Sending message of size {len(encoded_message)} bytes")
-            client.send(encoded_message)
+        # The device's sender delivers it on its own thread, so a rate limited
+        # upload doesn't freeze the tray while it runs
+        self.send_button.setEnabled(False)
+        self.send_button.setText("Sending...")
+        self._parent_ref.send_text_to_device(self.target_id, self.target_ip, text,
+                                             on_done=self.send_finished.emit)
+
+    def handle_send_finished(self, acknowledged):
+        self.send_button.setEnabled(True)
+        self.send_button.setText("Send")
+        if acknowledged:
             print("Message sent successfully")
-            client.close()
             QMessageBox.information(self, "Success", "Text sent successfully!")
             self.close()
-        except socket.timeout:
-            QMessageBox.warning(self, "Error", f"Connection timed out while trying to connect to {self.target_ip}:{self.port}")
-        except ConnectionRefusedError:
-            QMessageBox.warning(self, "Error", f"Connection refused by {self.target_ip}:{self.port} - Check if the target is running and the port is not blocked by firewall")
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to send text: {str(e)}\nTarget: {self.target_ip}:{self.port}")
+        else:
+            QMessageBox.warning(self, "Error", f"Failed to send text to {self.target_ip}:{self.port} - Check if the target is running and the port is not blocked by firewall")
 
 class TextHistoryDialog(QWidget):
     def __init__(self, texts, parent=None):
@@ -462,7 +2545,12 @@ def setup_ui(self):
                 text = text_entry['text']
                 sender = text_entry.get('sender_id', 'Unknown')
                 timestamp = text_entry.get('timestamp', '')
-                display_text = f"[{timestamp}] From {sender}\n\n{text}"  # Add extra newline for clarity
+                if isinstance(text, SpilledText):
+                    # Only show the start of very large clips, the rest stays on disk
+                    shown = f"{text.preview()}\n... ({len(text) / (1024 * 1024):.1f} MB)"
+                else:
+                    shown = text
+                display_text = f"[{timestamp}] From {sender}\n\n{shown}"  # Add extra newline for clarity
                 
                 item = QListWidgetItem(display_text)
                 item.setFlags(item.flags() | Qt.ItemIsSelectable)
@@ -507,13 +2595,13 @@ def copy_selected(self):
         if self.list_widget.currentItem():
             text = self.list_widget.currentItem().data(Qt.UserRole)
             clipboard = QApplication.clipboard()
-            clipboard.setText(text)
+            clipboard.setText(materialize(text))
             QMessageBox.information(self, "Copied", "Text copied to clipboard!")
     
     def copy_item(self, item):
         text = item.data(Qt.UserRole)
         clipboard = QApplication.clipboard()
-        clipboard.setText(text)
+        clipboard.setText(materialize(text))
         QMessageBox.information(self, "Copied", "Text copied to clipboard!")
     
     def clear_history(self):
@@ -525,17 +2613,13 @@ def clear_history(self):
             self.list_widget.clear()
 
 class Gweeb(QObject):
+    health_changed = Signal(str, str)  # device_id, new state
+    received_batch_ready = Signal()  # The first clip of a new batch was received
+
     def __init__(self, app):
         super().__init__()
         self.app = app
-        self.device_id = self.generate_device_id()
-        self.paired_devices = {}  # device_id -> (ip_address, interface_ip)
-        self.received_texts = []
-        self.current_dialog = None
-        self.auto_send_enabled = True  # Default to auto-send enabled
-        self.auto_receive_enabled = True  # Default to auto-receive enabled
-        self._suppress_clipboard_monitoring = False
-        self._last_clipboard_check = time.time()
+        self.init_state(self.generate_device_id())
         
         # Store the process ID
         self.pid = os.getpid()
@@ -549,6 +2633,15 @@ def __init__(self, app):
         self.pid_file = os.path.join(pid_dir, 'gweeb.pid')
         with open(self.pid_file, 'w') as f:
             f.write(str(self.pid))
+
+        # History and unsent clips are kept next to the pid file across restarts
+        self.history_file = os.path.join(pid_dir, 'history.json')
+        self.outbox_file = os.path.join(pid_dir, 'outbox.json')
+        self.sent_file = os.path.join(pid_dir, 'sent.json')
+        self.load_state()
+
+        # Profiles, memory reports and diagnostics bundles go next to them too
+        self.diagnostics = Diagnostics(os.path.join(pid_dir, 'diagnostics'), self.diagnostics_state)
         
         # Create system tray icon
         self.tray = QSystemTrayIcon()
@@ -572,14 +2665,34 @@ def __init__(self, app):
         
         # Start network listener first to get the interface
         self.listener = NetworkListener()
-        self.listener.text_received.connect(self.handle_received_text)
+        # History is updated on the network threads, the GUI only sees batches
+        self.listener.text_received.connect(self.ingest_received_text, Qt.DirectConnection)
+        self.listener.peer_health = self.peer_health.get
         self.listener.start()
+
+        # Pulls missing history entries from peers while history sync is on
+        self.history_sync = HistorySync(self.device_id, self.summarize_history, self.merge_history,
+                                        self.listener.interface_ip)
+        self.history_sync.start()
+
+        # Probe paired devices in the background to keep their health current
+        self.health_changed.connect(self.handle_health_changed)
+        self.heartbeat = HeartbeatMonitor(self.listener.interface_ip)
+        self.heartbeat.start()
+
+        # Small clips go over UDP next to the TCP listener when peers support it
+        try:
+            self.datagrams = DatagramChannel(self.listener)
+            self.datagrams.start()
+            self.listener.datagram_info = self.datagrams.info
+        except OSError as e:
+            print(f"UDP fast path unavailable: {e}")
         
         # Start device discovery with the same interface
         self.discovery = DeviceDiscovery()
         self.discovery.device_found.connect(self.handle_device_found)
         self.discovery.device_removed.connect(self.handle_device_removed)
-        self.discovery.start_advertising(self.device_id, self.listener.port)
+        self.discovery.start_advertising(self.device_id, self.listener.port, self.listener.addresses)
         
         # Show the tray icon
         if not self.tray.isSystemTrayAvailable():
@@ -600,6 +2713,82 @@ def __init__(self, app):
         self._clipboard_timer.timeout.connect(self.check_clipboard)
         self._clipboard_timer.start(1000)  # Check every second
 
+        # Measure how late timers fire, a sluggish GUI thread shows up here first
+        self._event_loop_due = time.monotonic() + EVENT_LOOP_CHECK_INTERVAL / 1000.0
+        self._event_loop_timer = QTimer()
+        self._event_loop_timer.timeout.connect(self._check_event_loop)
+        self._event_loop_timer.start(EVENT_LOOP_CHECK_INTERVAL)
+
+        # Python only runs signal handlers between bytecodes, which never happens
+        # while Qt sits in its event loop. Wake it up when a signal arrives so
+        # SIGTERM from a restarting instance is handled right away.
+        if not IS_WINDOWS:
+            self._signal_r, self._signal_w = socket.socketpair()
+            self._signal_w.setblocking(False)
+            signal.set_wakeup_fd(self._signal_w.fileno())
+            self._signal_notifier = QSocketNotifier(self._signal_r.fileno(), QSocketNotifier.Read)
+            self._signal_notifier.activated.connect(lambda: self._signal_r.recv(64))
+
+        # A restarting instance asks us to quit through this socket. It works on
+        # Windows too, where there is no SIGTERM and terminate() kills outright.
+        self.control_server = QLocalServer()
+        self.control_server.setSocketOptions(QLocalServer.UserAccessOption)
+        QLocalServer.removeServer(control_server_name())  # Left behind if the previous instance was killed
+        if self.control_server.listen(control_server_name()):
+            self.control_server.newConnection.connect(self.handle_control_connection)
+        else:
+            print(f"Failed to listen for stop requests: {self.control_server.errorString()}")
+
+    def handle_control_connection(self):
+        connection = self.control_server.nextPendingConnection()
+        connection.readyRead.connect(lambda: self.handle_control_request(connection))
+
+    def handle_control_request(self, connection):
+        if connection.canReadLine() and bytes(connection.readLine()).strip() == b'quit':
+            print("Asked to quit by a new instance")
+            cleanup()
+
+    def init_state(self, device_id):
+        """Set up the state Gweeb keeps apart from its tray, menu and network threads"""
+        self.device_id = device_id
+        self.paired_devices = {}  # device_id -> (ip_address, interface_ip)
+        self.device_features = {}  # device_id -> set of protocol features from discovery
+        self.received_texts = []
+        self.sent_texts = []  # Clips copied here, offered to peers in history sync
+        self._history_keys = set()  # history_entry_key() of received_texts entries with a seq
+        self._received_batch = []  # History entries waiting for handle_received_batch()
+        self._received_lock = threading.Lock()
+        self.current_dialog = None
+        self.auto_send_enabled = True  # Default to auto-send enabled
+        self.auto_receive_enabled = True  # Default to auto-receive enabled
+        self.delta_sync_enabled = True  # Send diffs against the last clip a peer acknowledged
+        self._acked_texts = {}  # device_id -> (hash, text) last clip the peer acknowledged
+        self._clip_cache = (None, None, {})  # Last clip sent, its hash and base hash -> delta
+        self.relay_enabled = True  # Fan out through relay peers instead of uploading to everyone
+        self.lazy_clipboard_enabled = False  # Render received text only when something pastes it
+        self.peer_senders = {}  # device_id -> PeerSender queueing clips for that device
+        self.upload_limit = None  # Global upload budget in bytes/s, None for unlimited
+        self.peer_upload_limits = {}  # device_id -> upload limit in bytes/s
+        self.peer_buckets = {}  # device_id -> TokenBucket enforcing that limit
+        self.adaptive_shaping_enabled = True  # Back off uploads when peer RTT rises
+        self.udp_fast_path_enabled = True  # Send clips that fit in a datagram over UDP
+        self.datagrams = None  # DatagramChannel, None if its port couldn't be bound
+        self.history_sync_enabled = False  # Fetch history entries we missed from peers, opt-in
+        self.peer_health = {}  # device_id -> PeerHealth tracking RTT and liveness
+        self.device_endpoints = {}  # device_id -> PeerEndpoint with the advertised addresses and port
+        self._outbox = {}  # (device_id, seq) -> clip queued for a device and not yet acknowledged
+        self._outbox_lock = threading.Lock()
+        self._restored_outbox = {}  # device_id -> outbox entries saved by the previous instance
+        self._shutting_down = False
+        self._suppress_clipboard_monitoring = False
+        self._last_clipboard_check = time.time()
+
+        # Clips received on the network threads reach the GUI in batches
+        self._received_timer = QTimer()
+        self._received_timer.setInterval(RECEIVE_BATCH_INTERVAL)
+        self._received_timer.timeout.connect(self._on_received_timer)
+        self.received_batch_ready.connect(self._on_received_batch_ready)
+
     def generate_device_id(self):
         """Generate a device ID based on the machine's hostname."""
         hostname = socket.gethostname()
@@ -615,6 +2804,7 @@ def show_menu(self, reason):
         if IS_WINDOWS or reason == QSystemTrayIcon.Trigger:  # Trigger is left click
             self.menu.popup(QCursor.pos())
 
+    @timed('gui_clipboard_change')
     def handle_clipboard_change(self):
         """Handle clipboard changes with rate limiting"""
         current_time = time.time()
@@ -622,7 +2812,10 @@ def handle_clipboard_change(self):
             return
         self._last_clipboard_check = current_time
         
-        if self._suppress_clipboard_monitoring:
+        if self._suppress_clipboard_monitoring or self._shutting_down:
+            return
+
+        if self._clipboard_has_lazy_clip():
             return
             
         if not self.auto_send_enabled:
@@ -636,32 +2829,174 @@ def handle_clipboard_change(self):
             self.last_clipboard_text = new_text
             
             # Check if this text was just received (to prevent loops)
-            if hasattr(self, '_last_received_text') and new_text == self._last_received_text:
+            if hasattr(self, '_last_received_hash') and self._clip_digest(new_text)[0] == self._last_received_hash:
                 print("Ignoring clipboard change from received text")
                 return
+
+            # One seq for every peer, so their histories know the copies are the same clip
+            seq = time.time_ns()
+            # Peers that are away catch up on it through history sync later
+            self.record_sent_clip(new_text, seq)
                 
             if self.paired_devices:
                 print(f"Found {len(self.paired_devices)} paired devices to send to")
                 # Temporarily suppress clipboard monitoring while sending
                 self._suppress_clipboard_monitoring = True
                 try:
-                    # Send to all connected devices
-                    for device_id, (ip, interface_ip) in self.paired_devices.items():
-                        print(f"Checking device {device_id} with IP {ip}")
-                        if is_valid_interface(ip) and is_valid_interface(interface_ip):
-                            print(f"Sending to device {device_id} at {ip}")
-                            self.send_text_to_device(device_id, ip, new_text)
-                        else:
-                            print(f"Skipping device {device_id} due to invalid interface")
+                    self.fan_out(self.fan_out_targets(), new_text, seq)
                 finally:
                     self._suppress_clipboard_monitoring = False
             else:
                 print("No paired devices found to send to")
 
-    def send_text_to_device(self, device_id, ip, text):
+    def fan_out(self, targets, text, seq):
+        """Send a clip to every target, through the relay tree if it is worth it"""
+        if self.should_relay(targets, text):
+            self.relay_to_devices(targets, text, seq)
+        else:
+            for device_id, ip, *_ in targets:
+                print(f"Sending to device {device_id} at {ip}")
+                self.send_text_to_device(device_id, ip, text, seq=seq)
+
+    def record_sent_clip(self, text, seq):
+        """Keep a clip copied here so history sync can offer it to peers that missed it"""
+        if len(text) > HISTORY_SYNC_PAGE_SIZE:
+            return  # Never synced anyway
+        entry = {'sender_id': self.device_id, 'text': text,
+                 'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'seq': seq}
+        with self._received_lock:
+            self.sent_texts.append(entry)
+            del self.sent_texts[:-HISTORY_SAVE_LIMIT]
+
+    def fan_out_targets(self):
+        """Return relay list entries for every paired device a clip should go to.
+
+        Entries are [device_id, ip, features, port, addresses], see relay_entry().
+
+        Devices that are down or flapping are skipped so they don't hold up a
+        relay subtree; the heartbeat brings them back once they answer again.
+        """
+        targets = []
+        for device_id, (ip, interface_ip) in self.paired_devices.items():
+            print(f"Checking device {device_id} with IP {ip}")
+            if not (is_valid_interface(ip) and is_valid_interface(interface_ip)):
+                print(f"Skipping device {device_id} due to invalid interface")
+                continue
+            health = self.peer_health.get(device_id)
+            if health and not health.is_available():
+                print(f"Skipping device {device_id}, it is {health.state}")
+                continue
+            features = self.device_features.get(device_id, ())
+            targets.append(relay_entry(device_id, self.get_peer_endpoint(device_id, ip), features))
+        return targets
+
+    def should_relay(self, targets, text):
+        """Whether a clip is large enough, and going to enough peers, to be worth relaying"""
+        return self.relay_enabled and len(targets) > RELAY_FANOUT and len(text) > RELAY_MIN_SIZE
+
+    def relay_to_devices(self, targets, text, seq):
+        """Upload text to a few relay peers which forward it to everyone else"""
+        print(f"Relaying to {len(targets)} devices with fan-out {RELAY_FANOUT}")
+        for (device_id, ip, *_), subtree in plan_relay_tree(targets):
+            print(f"Sending to device {device_id} at {ip} ({len(subtree)} downstream)")
+
+            def relay_fallback(acknowledged, device_id=device_id, subtree=subtree):
+                # While shutting down the clip stays in the outbox with its subtree instead
+                if not acknowledged and subtree and not self._shutting_down:
+                    print(f"Relay through {device_id} failed, delivering its subtree directly")
+                    threading.Thread(
+                        target=relay_text,
+                        args=(self.device_id, text, subtree, self.listener.port,
+                              self.listener.interface_ip, content_hash(text), seq, self.peer_health.get),
+                        daemon=True
+                    ).start()
+
+            self.send_text_to_device(device_id, ip, text, relay=subtree, on_done=relay_fallback, seq=seq)
+
+    def get_peer_endpoint(self, device_id, ip):
+        """Return where to reach a device, assuming our own port if it wasn't advertised"""
+        endpoint = self.device_endpoints.get(device_id)
+        if not endpoint or ip not in endpoint.addresses:
+            endpoint = PeerEndpoint([ip], self.listener.port)
+            self.device_endpoints[device_id] = endpoint
+        return endpoint
+
+    def get_peer_sender(self, device_id, ip, local_interface):
+        """Return the queued sender for a device, starting one if needed"""
+        sender = self.peer_senders.get(device_id)
+        features = self.device_features.get(device_id, ())
+        endpoint = self.get_peer_endpoint(device_id, ip)
+        queued = []
+        if sender and (sender.endpoint is not endpoint or sender.local_interface != local_interface
+                       or sender.features != set(features)):
+            # Messages the old sender hasn't started on move over to the new one
+            queued = sender.take_queued()
+            sender.stop()
+            sender = None
+        if not sender:
+            sender = PeerSender(device_id, endpoint, local_interface, features,
+                                bucket=self.get_peer_bucket(device_id),
+                                health=self.get_peer_health(device_id))
+            sender.adaptive = self.adaptive_shaping_enabled
+            if self.udp_fast_path_enabled:
+                sender.datagrams = self.datagrams
+            sender.start()
+            self.peer_senders[device_id] = sender
+        for message, callback in queued:
+            sender.send(message, callback)
+        return sender
+
+    def get_peer_health(self, device_id):
+        health = self.peer_health.get(device_id)
+        if not health:
+            health = PeerHealth(device_id, on_change=self.health_changed.emit)
+            self.peer_health[device_id] = health
+        return health
+
+    def handle_health_changed(self, device_id, state):
+        print(f"Device {device_id} is now {state}")
+        if device_id in self.paired_devices:
+            self.update_devices_menu()
+
+    def update_heartbeat_targets(self):
+        self.heartbeat.set_targets({
+            device_id: (self.get_peer_endpoint(device_id, ip), set(self.device_features.get(device_id, ())),
+                        self.get_peer_health(device_id))
+            for device_id, (ip, _) in self.paired_devices.items()
+        })
+
+    def get_peer_bucket(self, device_id):
+        bucket = self.peer_buckets.get(device_id)
+        if not bucket:
+            bucket = TokenBucket(self.peer_upload_limits.get(device_id))
+            self.peer_buckets[device_id] = bucket
+        return bucket
+
+    def set_upload_limit(self, limit):
+        self.upload_limit = limit
+        global_upload_bucket.set_limit(limit)
+        print(f"Global upload limit set to {format_rate(limit)}")
+        self.update_devices_menu()
+
+    def set_peer_upload_limit(self, device_id, limit):
+        if limit is None:
+            self.peer_upload_limits.pop(device_id, None)
+        else:
+            self.peer_upload_limits[device_id] = limit
+        self.get_peer_bucket(device_id).set_limit(limit)
+        print(f"Upload limit for {device_id} set to {format_rate(limit)}")
+        self.update_devices_menu()
+
+    def send_text_to_device(self, device_id, ip, text, relay=None, on_done=None, seq=None):
+        """Queue text for a device.
+
+        relay is an optional list of relay entries (see relay_entry()) the
+        device should forward the text to. on_done(acknowledged) is called
+        from a network thread once the device replied or the send failed.
+        """
         try:
-            print(f"Creating socket to send text to {device_id} at {ip}")
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            print(f"Sending text to {device_id} at {ip}")
+            local_interface = None
             if hasattr(self, 'listener'):
                 local_interface = self.listener.interface_ip
                 if not is_valid_interface(local_interface):
@@ -669,28 +3004,77 @@ def send_text_to_device(self, device_id, ip, text):
                     local_interface = get_local_ip()
                     if not is_valid_interface(local_interface):
                         print(f"Could not find valid zerotier interface")
+                        if on_done:
+                            on_done(False)
                         return
-                
-                local_addr = (local_interface, 0)
-                client.bind(local_addr)
-                print(f"Bound client to local interface: {local_addr[0]}")
-            
-            client.settimeout(5)
-            print(f"Connecting to {ip}:{self.listener.port}...")
-            client.connect((ip, self.listener.port))
-            print("Connected successfully")
-            
+
+            text_hash, deltas = self._clip_digest(text)
             message = {
                 'sender_id': self.device_id,
-                'text': text
+                'text': text,
+                'hash': text_hash,
+                'seq': seq or time.time_ns()
             }
-            encoded_message = json.dumps(message).encode('utf-8')
-            print(f"Sending message of size {len(encoded_message)} bytes")
-            client.send(encoded_message)
-            client.close()
-            print(f"Successfully sent text to {device_id}")
+            if relay:
+                message['relay'] = relay_list_for(self.device_features.get(device_id, ()), relay)
+
+            # Send only what changed if the peer acknowledged a previous clip from us
+            acked = self._acked_texts.get(device_id)
+            delta = None
+            if self.delta_sync_enabled and acked:
+                # Peers that acknowledged the same clip share one delta
+                if acked[0] not in deltas:
+                    deltas[acked[0]] = make_delta(acked[1], text)
+                delta = deltas[acked[0]]
+            if delta:
+                delta = dict(delta, base=acked[0])
+                print(f"Sending delta against {acked[0][:8]} ({len(delta['insert'])} of {len(text)} chars)")
+                first_message = {key: value for key, value in message.items() if key != 'text'}
+                first_message['delta'] = delta
+            else:
+                first_message = message
+
+            sender = self.get_peer_sender(device_id, ip, local_interface)
+            outbox_key = (device_id, message['seq'])
+            with self._outbox_lock:
+                self._outbox[outbox_key] = {'device_id': device_id, 'text': text,
+                                            'seq': message['seq'], 'relay': relay}
+
+            def handle_reply(reply, full_send=delta is None):
+                if not full_send and reply and reply.get('status') == 'need_base':
+                    print(f"{device_id} does not have the delta base, falling back to full send")
+                    # The sender may have been replaced since, its queue moved to the new one
+                    self.peer_senders.get(device_id, sender).send(
+                        message, lambda reply: handle_reply(reply, True))
+                    return
+                acknowledged = bool(reply and reply.get('status') == 'ok' and reply.get('hash') == text_hash)
+                if acknowledged or not self._shutting_down:
+                    # Sends cut off by shutting down stay in the outbox to be saved
+                    with self._outbox_lock:
+                        self._outbox.pop(outbox_key, None)
+                if acknowledged:
+                    self._acked_texts[device_id] = (text_hash, text)
+                    print(f"Successfully sent text to {device_id}")
+                else:
+                    self._acked_texts.pop(device_id, None)
+                if on_done:
+                    on_done(acknowledged)
+
+            sender.send(first_message, handle_reply)
         except Exception as e:
+            self._acked_texts.pop(device_id, None)
             print(f"Failed to send text to {device_id}: {str(e)}")
+            if on_done:
+                on_done(False)
+
+    def _clip_digest(self, text):
+        """Return the hash of text and a dict caching its deltas by base hash.
+        Both are computed once per clip instead of once per device."""
+        cached = self._clip_cache
+        if cached[0] is not text:
+            cached = (text, content_hash(text), {})
+            self._clip_cache = cached
+        return cached[1], cached[2]
 
     def toggle_auto_send(self):
         self.auto_send_enabled = not self.auto_send_enabled
@@ -700,6 +3084,56 @@ def toggle_auto_receive(self):
         self.auto_receive_enabled = not self.auto_receive_enabled
         print(f"Auto-copy received text {'enabled' if self.auto_receive_enabled else 'disabled'}")
 
+    def toggle_delta_sync(self):
+        self.delta_sync_enabled = not self.delta_sync_enabled
+        if not self.delta_sync_enabled:
+            self._acked_texts.clear()
+        print(f"Delta sync {'enabled' if self.delta_sync_enabled else 'disabled'}")
+
+    def toggle_relay(self):
+        self.relay_enabled = not self.relay_enabled
+        print(f"Relay fan-out {'enabled' if self.relay_enabled else 'disabled'}")
+
+    def toggle_adaptive_shaping(self):
+        self.adaptive_shaping_enabled = not self.adaptive_shaping_enabled
+        for sender in self.peer_senders.values():
+            sender.adaptive = self.adaptive_shaping_enabled
+        if not self.adaptive_shaping_enabled:
+            # Drop any backoff still in effect
+            for device_id, bucket in self.peer_buckets.items():
+                bucket.set_limit(self.peer_upload_limits.get(device_id))
+        print(f"Adaptive upload backoff {'enabled' if self.adaptive_shaping_enabled else 'disabled'}")
+
+    def toggle_udp_fast_path(self):
+        self.udp_fast_path_enabled = not self.udp_fast_path_enabled
+        for sender in self.peer_senders.values():
+            sender.datagrams = self.datagrams if self.udp_fast_path_enabled else None
+        print(f"UDP fast path {'enabled' if self.udp_fast_path_enabled else 'disabled'}")
+
+    def toggle_history_sync(self):
+        if self.history_sync_enabled:
+            self.history_sync.key = None
+        else:
+            # Device ids are public, so peers prove they know a passphrase set on every machine
+            passphrase, ok = QInputDialog.getText(
+                None, "Sync History with Peers",
+                "Passphrase shared by the machines allowed to sync your history:", QLineEdit.Password)
+            if not ok or not passphrase:
+                print("History sync not enabled, no passphrase given")
+                self.update_devices_menu()  # Uncheck the menu item again
+                return
+            self.history_sync.key = history_sync_key(passphrase)
+        self.history_sync_enabled = not self.history_sync_enabled
+        self.listener.history_source = self.answer_history_sync if self.history_sync_enabled else None
+        if self.history_sync_enabled:
+            for device_id in list(self.paired_devices):
+                self.sync_history_with(device_id)
+        print(f"History sync {'enabled' if self.history_sync_enabled else 'disabled'}")
+
+    def toggle_lazy_clipboard(self):
+        self.lazy_clipboard_enabled = not self.lazy_clipboard_enabled
+        print(f"Lazy clipboard {'enabled' if self.lazy_clipboard_enabled else 'disabled'}")
+
     def setup_menu(self):
         # Create main menu
         main_menu = QMenu()
@@ -713,7 +3147,17 @@ def setup_menu(self):
         # Connected Devices section
         if self.paired_devices:
             for device_id, (ip, interface_ip) in self.paired_devices.items():
-                device_submenu = main_menu.addMenu(device_id)
+                health = self.get_peer_health(device_id)
+                title = device_id if health.state in ('up', 'unknown') else f"{device_id} ({health.state})"
+                device_submenu = main_menu.addMenu(title)
+
+                # Health of this device, refreshed whenever the submenu opens
+                health_action = device_submenu.addAction(f"Health: {health.describe()}")
+                health_action.setEnabled(False)
+                device_submenu.aboutToShow.connect(
+                    lambda a=health_action, h=health: a.setText(f"Health: {h.describe()}")
+                )
+                device_submenu.addSeparator()
                 
                 # Send text action for this device
                 send_action = device_submenu.addAction("Send Text...")
@@ -726,6 +3170,12 @@ def setup_menu(self):
                 history_action.triggered.connect(
                     lambda checked=False, d=device_id: self.show_device_history(d)
                 )
+
+                # Upload limit for this device
+                self.add_upload_limit_menu(
+                    device_submenu, self.peer_upload_limits.get(device_id),
+                    lambda limit, d=device_id: self.set_peer_upload_limit(d, limit)
+                )
         
         main_menu.addSeparator()
         
@@ -743,6 +3193,56 @@ def setup_menu(self):
         auto_receive_action.setCheckable(True)
         auto_receive_action.setChecked(self.auto_receive_enabled)
         auto_receive_action.triggered.connect(self.toggle_auto_receive)
+
+        # Delta sync toggle
+        delta_sync_action = settings_menu.addAction("Delta Sync for Edited Clips")
+        delta_sync_action.setCheckable(True)
+        delta_sync_action.setChecked(self.delta_sync_enabled)
+        delta_sync_action.triggered.connect(self.toggle_delta_sync)
+
+        # Relay fan-out toggle
+        relay_action = settings_menu.addAction("Relay Fan-out for Large Networks")
+        relay_action.setCheckable(True)
+        relay_action.setChecked(self.relay_enabled)
+        relay_action.triggered.connect(self.toggle_relay)
+
+        # Lazy clipboard toggle
+        lazy_clipboard_action = settings_menu.addAction("Copy Received Text Only When Pasted")
+        lazy_clipboard_action.setCheckable(True)
+        lazy_clipboard_action.setChecked(self.lazy_clipboard_enabled)
+        lazy_clipboard_action.triggered.connect(self.toggle_lazy_clipboard)
+
+        # Global upload budget
+        self.add_upload_limit_menu(settings_menu, self.upload_limit, self.set_upload_limit)
+
+        # Adaptive backoff toggle
+        adaptive_action = settings_menu.addAction("Slow Uploads When Latency Rises")
+        adaptive_action.setCheckable(True)
+        adaptive_action.setChecked(self.adaptive_shaping_enabled)
+        adaptive_action.triggered.connect(self.toggle_adaptive_shaping)
+
+        # UDP fast path toggle
+        udp_action = settings_menu.addAction("Send Small Clips over UDP")
+        udp_action.setCheckable(True)
+        udp_action.setChecked(self.udp_fast_path_enabled)
+        udp_action.triggered.connect(self.toggle_udp_fast_path)
+
+        # History sync toggle
+        history_sync_action = settings_menu.addAction("Sync History with Peers")
+        history_sync_action.setCheckable(True)
+        history_sync_action.setChecked(self.history_sync_enabled)
+        history_sync_action.triggered.connect(self.toggle_history_sync)
+
+        # Diagnostics submenu
+        diagnostics_menu = main_menu.addMenu("Diagnostics")
+        profile_action = diagnostics_menu.addAction("Profile Threads")
+        profile_action.setCheckable(True)
+        profile_action.setChecked(self.diagnostics.profiling)
+        profile_action.triggered.connect(self.toggle_profiling)
+        memory_action = diagnostics_menu.addAction("Take Memory Snapshot")
+        memory_action.triggered.connect(self.take_memory_snapshot)
+        bundle_action = diagnostics_menu.addAction("Write Diagnostics Bundle")
+        bundle_action.triggered.connect(self.write_diagnostics_bundle)
         
         # View all history (in main menu)
         view_history_action = main_menu.addAction("View All History")
@@ -758,6 +3258,84 @@ def setup_menu(self):
         self.menu = main_menu
         self.tray.setContextMenu(main_menu)
 
+    def toggle_profiling(self):
+        if self.diagnostics.profiling:
+            self.stop_profiling()
+        else:
+            self.start_profiling()
+
+    def start_profiling(self):
+        self.diagnostics.start_profile()
+        self.update_devices_menu()
+
+    def stop_profiling(self):
+        paths = self.diagnostics.stop_profile()
+        self.update_devices_menu()
+        if paths:
+            self.show_diagnostics_message(f"Profile written to {os.path.dirname(paths[0])}")
+
+    def take_memory_snapshot(self):
+        try:
+            path = self.diagnostics.take_memory_snapshot()
+        except Exception as e:
+            print(f"Failed to take memory snapshot: {e}")
+            return
+        self.show_diagnostics_message(f"Memory snapshot written to {path}")
+
+    def write_diagnostics_bundle(self):
+        try:
+            path = self.diagnostics.write_bundle()
+        except Exception as e:
+            print(f"Failed to write diagnostics bundle: {e}")
+            return
+        self.show_diagnostics_message(f"Diagnostics written to {path}")
+
+    def show_diagnostics_message(self, text):
+        self.tray.showMessage("Gweeb", text, QSystemTrayIcon.Information, 4000)
+
+    def diagnostics_state(self):
+        """Sizes of what Gweeb keeps in memory and the state of its peers, for diagnostics"""
+        with self._received_lock:
+            history = list(self.received_texts)
+        with self._outbox_lock:
+            outbox = list(self._outbox.values())
+        with self.listener._lock:
+            delta_bases = [text for _, text in self.listener.last_texts.values()]
+        spilled = [entry['text'] for entry in history if isinstance(entry['text'], SpilledText)]
+        peers = {}
+        for device_id in list(self.paired_devices):
+            sender = self.peer_senders.get(device_id)
+            peers[device_id] = {'health': self.get_peer_health(device_id).describe(),
+                                'queued': len(sender.interactive) + len(sender.bulk) if sender else 0}
+        return {
+            'history_entries': len(history),
+            'history_bytes': sum(len(entry['text']) for entry in history) - sum(len(t) for t in spilled),
+            'history_spilled_bytes': sum(len(t) for t in spilled),
+            'clipboard_copy_bytes': len(self.last_clipboard_text or ''),
+            'acked_text_bytes': sum(len(text) for _, text in self._acked_texts.values()),
+            'delta_base_bytes': sum(len(text) for text in delta_bases),
+            'outbox_clips': len(outbox),
+            'outbox_bytes': sum(len(entry['text']) for entry in outbox),
+            'peers': peers,
+            'settings': {name: getattr(self, name) for name in (
+                'auto_send_enabled', 'auto_receive_enabled', 'delta_sync_enabled', 'relay_enabled',
+                'lazy_clipboard_enabled', 'adaptive_shaping_enabled', 'udp_fast_path_enabled',
+                'history_sync_enabled', 'upload_limit')},
+        }
+
+    def _check_event_loop(self):
+        now = time.monotonic()
+        TIMINGS.record('gui_event_loop_lag', max(0.0, now - self._event_loop_due))
+        self._event_loop_due = now + EVENT_LOOP_CHECK_INTERVAL / 1000.0
+
+    def add_upload_limit_menu(self, parent_menu, current, on_select):
+        limit_menu = parent_menu.addMenu(f"Upload Limit ({format_rate(current)})")
+        for limit in UPLOAD_LIMIT_CHOICES:
+            action = limit_menu.addAction(format_rate(limit))
+            action.setCheckable(True)
+            action.setChecked(limit == current)
+            action.triggered.connect(lambda checked=False, l=limit: on_select(l))
+
     def show_device_send_dialog(self, device_id):
         """Show send dialog for a specific device"""
         if device_id not in self.paired_devices:
@@ -810,51 +3388,176 @@ def show_device_history(self, device_id):
         dialog.raise_()
         dialog.activateWindow()
 
-    def handle_received_text(self, sender_id, text):
-        if sender_id in self.paired_devices:
+    @timed('ingest_received_text')
+    def ingest_received_text(self, sender_id, text, latest=True, seq=None):
+        """Add a received clip to the history. Runs on the network thread.
+
+        Clips that are the newest from their sender are also queued for
+        handle_received_batch(), which the GUI thread runs at most once per
+        RECEIVE_BATCH_INTERVAL however fast clips arrive.
+        """
+        if sender_id not in self.paired_devices:
+            print(f"Received text from unknown sender {sender_id}")
+            return
+        entry = {
+            'sender_id': sender_id,
+            'text': text,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        if seq is not None:
+            entry['seq'] = seq  # Identifies the clip for history sync
+        with self._received_lock:
+            key = history_entry_key(entry) if seq is not None else None
+            if key in self._history_keys:
+                # History sync got it from another peer while it was on its way here
+                print(f"Text from {sender_id} is already in the history")
+            else:
+                self.received_texts.append(entry)
+                if key:
+                    self._history_keys.add(key)
+            if not latest:
+                # A newer clip from this sender already arrived, keep this one in history only
+                print(f"Received older text from {sender_id} after a newer one, saved to history only")
+                return
             print(f"Received text from {sender_id}, length: {len(text)}")
-            # Store text with metadata
-            text_entry = {
-                'sender_id': sender_id,
-                'text': text,
-                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
-            }
-            self.received_texts.append(text_entry)
-            
-            # Only copy to clipboard if auto-receive is enabled
-            if self.auto_receive_enabled:
-                print(f"Auto-receive enabled, copying text to clipboard")
-                # Store the text we're about to receive to prevent loops
-                self._last_received_text = text
-                clipboard = QApplication.clipboard()
-                clipboard.setText(text)
-                notification_text = f"Text copied from {sender_id}"
+            self._received_batch.append(entry)
+            first = len(self._received_batch) == 1
+        if first:
+            self.received_batch_ready.emit()
+
+    def _on_received_batch_ready(self):
+        # The first clip after a quiet period is handled right away, clips
+        # arriving while the timer runs wait for its next tick
+        if not self._received_timer.isActive():
+            self.handle_received_batch()
+            self._received_timer.start()
+
+    def _on_received_timer(self):
+        if not self.handle_received_batch():
+            self._received_timer.stop()
+
+    @timed('gui_received_batch')
+    def handle_received_batch(self):
+        """Put the newest received clip on the clipboard and notify once for
+        the whole batch. Returns False if nothing was waiting."""
+        with self._received_lock:
+            batch, self._received_batch = self._received_batch, []
+        if not batch:
+            return False
+        newest = batch[-1]
+        sender_id, text = newest['sender_id'], newest['text']
+        senders = sorted(set(entry['sender_id'] for entry in batch))
+
+        # Only copy to clipboard if auto-receive is enabled
+        if self.auto_receive_enabled:
+            print(f"Auto-receive enabled, copying text to clipboard")
+            # Store the text we're about to receive to prevent loops
+            self._last_received_hash = content_hash(text)
+            if self.lazy_clipboard_enabled:
+                self.clipboard.setMimeData(LazyClipMimeData(text))
             else:
-                print(f"Auto-receive disabled, text saved to history only")
-                notification_text = f"Text received from {sender_id}"
-            
-            # Show notification
-            try:
-                if IS_LINUX and show_linux_notification("Gweeb", notification_text):
-                    pass  # Linux notification shown successfully
-                else:
-                    # Fallback to Qt notifications
-                    self.tray.showMessage(
-                        "Gweeb",  # Title
-                        notification_text,  # Message
-                        QSystemTrayIcon.Information,  # Icon
-                        2000  # Duration in ms (2 seconds)
-                    )
-            except Exception as e:
-                print(f"Failed to show notification: {e}")
+                self.clipboard.setText(materialize(text))
+            notification_text = f"Text copied from {sender_id}"
+            if len(batch) > 1:
+                notification_text = (f"{len(batch)} clips received from {', '.join(senders)}, "
+                                     f"newest copied from {sender_id}")
         else:
-            print(f"Received text from unknown sender {sender_id}")
+            print(f"Auto-receive disabled, text saved to history only")
+            notification_text = f"Text received from {sender_id}"
+            if len(batch) > 1:
+                notification_text = f"{len(batch)} clips received from {', '.join(senders)}"
+
+        # Show notification
+        try:
+            if IS_LINUX and show_linux_notification("Gweeb", notification_text):
+                pass  # Linux notification shown successfully
+            else:
+                # Fallback to Qt notifications
+                self.tray.showMessage(
+                    "Gweeb",  # Title
+                    notification_text,  # Message
+                    QSystemTrayIcon.Information,  # Icon
+                    2000  # Duration in ms (2 seconds)
+                )
+        except Exception as e:
+            print(f"Failed to show notification: {e}")
+        return True
+
+    def summarize_history(self):
+        with self._received_lock:
+            entries = self.received_texts + self.sent_texts
+        return history_summary(entries)
+
+    @timed('history_sync_answer')
+    def answer_history_sync(self, message, address):
+        """Reply to a history sync request from address with the entries the
+        peer is missing. Runs on the network thread."""
+        sender_id = message['sender_id']
+        if sender_id not in self.paired_devices:
+            print(f"History sync request from unknown sender {sender_id}")
+            return {'status': 'unknown_sender'}
+        endpoint = self.device_endpoints.get(sender_id)
+        known = {self.paired_devices[sender_id][0]} | set(endpoint.addresses if endpoint else ())
+        if address.split('%')[0] not in {a.split('%')[0] for a in known}:
+            print(f"History sync request for {sender_id} came from {address}, not one of its addresses")
+            return {'status': 'unauthorized'}
+        key = self.history_sync.key
+        if key is None or not verify_history_request(key, message):
+            print(f"History sync request from {sender_id} is not signed with our passphrase")
+            return {'status': 'unauthorized'}
+        with self._received_lock:
+            entries = self.received_texts + self.sent_texts
+        try:
+            page, more = missing_history(entries, message['summary'], exclude=sender_id)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Invalid history summary from {sender_id}: {e}")
+            return {'status': 'error'}
+        print(f"Sending {len(page)} history entries to {sender_id}" + (" (more to come)" if more else ""))
+        return {'status': 'ok', 'entries': page, 'more': more}
 
-    def handle_device_found(self, device_id, ip_address, interface_ip):
+    def merge_history(self, entries):
+        """Add history entries fetched from a peer, skipping ones we already have.
+        Returns the number added."""
+        with self._received_lock:
+            added = []
+            for entry in entries:
+                if not is_record(entry, {'sender_id': str, 'seq': int, 'text': str}):
+                    continue
+                key = history_entry_key(entry)
+                if entry['sender_id'] == self.device_id or key in self._history_keys:
+                    continue
+                self._history_keys.add(key)
+                added.append({'sender_id': entry['sender_id'], 'text': entry['text'],
+                              'timestamp': str(entry.get('timestamp', '')), 'seq': entry['seq']})
+            self.received_texts.extend(added)
+        return len(added)
+
+    def sync_history_with(self, device_id):
+        if self.history_sync_enabled and 'history' in self.device_features.get(device_id, ()):
+            ip = self.paired_devices[device_id][0]
+            self.history_sync.request(device_id, self.get_peer_endpoint(device_id, ip),
+                                      self.get_peer_health(device_id))
+
+    def handle_device_found(self, device_id, ip_address, interface_ip, features=None, endpoint=None):
         if device_id != self.device_id:  # Don't add ourselves
             if is_valid_interface(ip_address) and is_valid_interface(interface_ip):
+                newly_paired = device_id not in self.paired_devices
                 self.paired_devices[device_id] = (ip_address, interface_ip)
+                self.device_features[device_id] = set(features or ())
+                known = self.device_endpoints.get(device_id)
+                if endpoint and not (known and known.addresses == endpoint.addresses
+                                     and known.port == endpoint.port):
+                    # Keep the known endpoint while nothing changed so its preferred address survives
+                    self.device_endpoints[device_id] = endpoint
                 print(f"Added device {device_id} at {ip_address} (interface: {interface_ip})")
+                for entry in self._restored_outbox.pop(device_id, []):
+                    print(f"Resending clip saved at shutdown to {device_id}")
+                    self.send_text_to_device(device_id, ip_address, entry['text'],
+                                             relay=entry['relay'], seq=entry['seq'])
+                self.update_heartbeat_targets()
+                if newly_paired:
+                    # Catch up on clips sent while one of us was away
+                    self.sync_history_with(device_id)
                 self.update_devices_menu()
             else:
                 print(f"Ignoring device {device_id} due to invalid interface: {ip_address} / {interface_ip}")
@@ -862,6 +3565,14 @@ def handle_device_found(self, device_id, ip_address, interface_ip):
     def handle_device_removed(self, device_id):
         if device_id in self.paired_devices:
             del self.paired_devices[device_id]
+            self._acked_texts.pop(device_id, None)
+            self.device_features.pop(device_id, None)
+            self.peer_health.pop(device_id, None)
+            self.device_endpoints.pop(device_id, None)
+            sender = self.peer_senders.pop(device_id, None)
+            if sender:
+                sender.stop()
+            self.update_heartbeat_targets()
             self.update_devices_menu()
 
     def update_devices_menu(self):
@@ -887,41 +3598,159 @@ def show_history_dialog(self):
         dialog.raise_()
         dialog.activateWindow()
 
-    def force_quit(self):
-        """Force quit the application and cleanup"""
-        print("Force quitting Gweeb...")
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        """Stop Gweeb within timeout seconds.
+
+        Peers are told we are leaving first so they stop sending to us, and
+        queued clips get until the deadline to go out. Whatever is still
+        unacknowledged by then is saved to the outbox, along with the history,
+        and sent again after a restart.
+        """
+        if self._shutting_down:
+            return
+        self._shutting_down = True
+        print("Shutting down Gweeb...")
+        deadline = time.monotonic() + timeout
+        if self.diagnostics.profiling:
+            self.diagnostics.stop_profile()
+        self._clipboard_timer.stop()
+        self._event_loop_timer.stop()
+        self.heartbeat.stop()
+        self.history_sync.stop()
+        self.listener.stop()
+        # Unregistering sends the zeroconf goodbye packets, which takes a moment
+        goodbye = threading.Thread(target=self.discovery.stop, daemon=True)
+        goodbye.start()
+
+        while time.monotonic() < deadline:
+            with self._outbox_lock:
+                if not self._outbox:
+                    break
+            self.app.processEvents()
+            time.sleep(0.01)
+        # No more acks may arrive once the outbox is saved, or clips acknowledged
+        # after the save would be sent again after a restart
+        senders = list(self.peer_senders.values())
+        for sender in senders:
+            sender.stop()
+        if self.datagrams:
+            self.datagrams.stop()
+            senders.append(self.datagrams)
+        # Sends cut short by stopping report back quickly, give them a moment even past the deadline
+        join_deadline = max(deadline, time.monotonic() + 0.5)
+        for sender in senders:
+            sender.join(max(0, join_deadline - time.monotonic()))
         try:
-            self.discovery.stop()
-            self.listener.stop()
-            self.listener.wait()
-            self.tray.hide()
-            self.app.quit()
-        except:
-            pass
-        
+            self.save_state()
+        except Exception as e:
+            print(f"Failed to save state: {e}")
+
+        goodbye.join(max(0, deadline - time.monotonic()))
+        self.listener.close_connections()
+        self.listener.wait(max(100, int((deadline - time.monotonic()) * 1000)))
+        self.control_server.close()
+        self.tray.hide()
+        self.handle_received_batch()
+        if self._clipboard_has_lazy_clip():
+            # Render the pending clip so it can still be pasted after we exit
+            self.clipboard.setText(self.clipboard.text())
+
         # Remove PID file
         try:
             if os.path.exists(self.pid_file):
                 os.remove(self.pid_file)
         except:
             pass
-            
-        # Kill our process and children
-        force_kill_process(self.pid)
+        self.app.quit()
+
+    def save_state(self):
+        """Save the history and the clips no peer acknowledged yet"""
+        history = []
+        for entry in self.received_texts[-HISTORY_SAVE_LIMIT:]:
+            if len(entry['text']) <= STATE_MAX_CLIP:
+                history.append(dict(entry, text=materialize(entry['text'])))
+        save_json(self.history_file, history)
+        with self._received_lock:
+            sent = list(self.sent_texts)
+        save_json(self.sent_file, sent)
+
+        with self._outbox_lock:
+            pending = list(self._outbox.values())
+        # Clips restored for devices that haven't shown up again are kept too
+        for entries in self._restored_outbox.values():
+            pending.extend(entries)
+        outbox = [dict(entry, text=materialize(entry['text']))
+                  for entry in pending if len(entry['text']) <= STATE_MAX_CLIP]
+        skipped = len(pending) - len(outbox)
+        save_json(self.outbox_file, outbox)
+        print(f"Saved {len(history)} history entries and {len(outbox)} unsent clips"
+              + (f" ({skipped} too large to keep)" if skipped else ""))
+
+    def load_state(self):
+        """Restore the history and outbox saved by the previous instance"""
+        history = load_json(self.history_file, [])
+        for entry in history if isinstance(history, list) else []:
+            if not is_record(entry, {'sender_id': str, 'text': str}) or not isinstance(entry.get('seq', 0), int):
+                continue
+            restored = {'sender_id': entry['sender_id'], 'text': entry['text'],
+                        'timestamp': str(entry.get('timestamp', ''))}
+            if 'seq' in entry:
+                restored['seq'] = entry['seq']
+                self._history_keys.add(history_entry_key(restored))
+            self.received_texts.append(restored)
+
+        sent = load_json(self.sent_file, [])
+        for entry in sent if isinstance(sent, list) else []:
+            if is_record(entry, {'text': str, 'seq': int}):
+                self.sent_texts.append({'sender_id': self.device_id, 'text': entry['text'],
+                                        'timestamp': str(entry.get('timestamp', '')), 'seq': entry['seq']})
+
+        now = time.time_ns()
+        outbox = load_json(self.outbox_file, [])
+        for entry in outbox if isinstance(outbox, list) else []:
+            if not is_record(entry, {'device_id': str, 'text': str, 'seq': int}):
+                continue
+            relay = entry.get('relay')
+            if relay is not None and not (isinstance(relay, list)
+                                          and all(isinstance(item, list) and len(item) >= 3 for item in relay)):
+                continue
+            if now - entry['seq'] < OUTBOX_MAX_AGE * 1_000_000_000:
+                self._restored_outbox.setdefault(entry['device_id'], []).append(
+                    {'device_id': entry['device_id'], 'text': entry['text'], 'seq': entry['seq'], 'relay': relay})
+        if self.received_texts or self._restored_outbox:
+            print(f"Restored {len(self.received_texts)} history entries and "
+                  f"{sum(len(e) for e in self._restored_outbox.values())} unsent clips")
 
     def quit_app(self):
         """Normal quit with cleanup"""
-        print("Shutting down Gweeb...")
         cleanup()
 
+    def _clipboard_has_lazy_clip(self):
+        # Reading the text of our own lazy clip would render it, and it came
+        # from a peer anyway so it must not be sent back out
+        return isinstance(self.clipboard.mimeData(), LazyClipMimeData)
+
     def check_clipboard(self):
         """Periodically check clipboard contents"""
         if not self._suppress_clipboard_monitoring and self.auto_send_enabled:
+            if self._clipboard_has_lazy_clip():
+                return
             current_text = self.clipboard.text()
             if current_text and current_text != self.last_clipboard_text:
                 self.handle_clipboard_change()
 
 if __name__ == '__main__':
+    # Keep recent output and errors for diagnostics bundles, nothing else sees a tray app's stdout
+    LOG_TAIL.install()
+    parser = argparse.ArgumentParser(description="Share clipboard text between machines on the same network")
+    parser.add_argument('--profile', type=float, nargs='?', const=0, metavar='SECONDS',
+                        help="Profile all threads from startup, for SECONDS or until Gweeb quits")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Trace allocations from startup so memory snapshots include it")
+    args, qt_args = parser.parse_known_args()
+    if args.trace_memory:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
     # Add psutil to requirements if not present
     try:
         import psutil
@@ -964,16 +3793,18 @@ def check_clipboard(self):
         try:
             with open(pid_file, 'r') as f:
                 old_pid = int(f.read().strip())
-            try:
-                # Try to kill the old process if it exists
-                force_kill_process(old_pid)
-            except:
-                pass
-            os.remove(pid_file)
+            # Let the old instance save its history and outbox before we load them
+            stop_process(old_pid)
+            if os.path.exists(pid_file):
+                os.remove(pid_file)
         except:
             pass
     
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setQuitOnLastWindowClosed(False)
     gweeb = Gweeb(app)
+    if args.profile is not None:
+        gweeb.start_profiling()
+        if args.profile > 0:
+            QTimer.singleShot(int(args.profile * 1000), gweeb.stop_profiling)
     sys.exit(app.exec())
\ No newline at end of file